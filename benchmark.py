@@ -0,0 +1,373 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import HTTPServer
+
+import requests
+
+from fakexm import start_fake
+from sxm import SiriusXM, PooledHTTPServer, make_sirius_handler
+
+# Repeatable benchmarks of sxm.py against the local stand-in in fakexm.py.
+# Nothing here talks to the real service.
+#   python benchmark.py                       all scenarios, 100 listeners
+#   python benchmark.py playlists segments --listeners 200 --server-mode single
+
+def settings_for(fake, **overrides):
+    settings = {
+        "api_url": fake.base + "/api/{}",
+        "cdn_url": fake.base + "/img/{}",
+        "catalog_cache": "",
+        "catalog_refresh": "0",
+        "cdn_pool_size": "128",
+    }
+    settings.update({k: str(v) for k, v in overrides.items()})
+    return settings
+
+def start_proxy(sxm, mode, workers):
+    handler = make_sirius_handler(sxm)
+    handler.log_message = lambda *args: None
+    if mode == "single":
+        httpd = HTTPServer(('127.0.0.1', 0), handler)
+    else:
+        httpd = PooledHTTPServer(('127.0.0.1', 0), handler, workers)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, "http://127.0.0.1:{}".format(httpd.server_address[1])
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def fetch(url):
+    with urllib.request.urlopen(url, timeout=30) as res:
+        return res.read()
+
+def run_clients(listeners, duration, client):
+    return summarize(*collect(listeners, duration, client))
+
+def collect(listeners, duration, client):
+    # runs `client(n)` in a loop on `listeners` threads for `duration` seconds;
+    # client returns (latencies, bytes) of what it did in one pass
+    latencies = []
+    errors = [0]
+    total = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    def worker(n):
+        while time.time() < deadline:
+            try:
+                took, size = client(n)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.extend(took)
+                total[0] += size
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(listeners)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0], total[0], time.time() - start
+
+def summarize(latencies, errors, total, elapsed):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mb_per_s": total / elapsed / 1e6
+    }
+
+def report(name, results):
+    print("{:<28} {}".format(name, "  ".join("{}={}".format(k, round(v, 2) if isinstance(v, float) else v) for k, v in results.items())))
+
+def timed(url):
+    start = time.perf_counter()
+    data = fetch(url)
+    return time.perf_counter() - start, data
+
+def linear_channels(sxm, count):
+    return [channel for channel in sxm.get_channels() if channel.channel_type == "channel-linear"][:count]
+
+def bench_cold_start(args):
+    fake, server = start_fake(channels=args.channels, latency=args.latency)
+    workdir = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(workdir, "channels.json")
+        for name in ("cold start", "warm start"):
+            start = time.perf_counter()
+            sxm = SiriusXM("user", "pass", settings_for(fake, catalog_cache=cache))
+            sxm.get_playlist()
+            report(name, {"seconds": time.perf_counter() - start, "channels": len(sxm.channels)})
+        report("upstream", fake.stats()["requests"])
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+def bench_lookup(args):
+    fake, server = start_fake(channels=args.channels)
+    try:
+        sxm = SiriusXM("user", "pass", settings_for(fake))
+        channels = list(sxm.get_channels())
+        ids = [channel.id for channel in channels]
+        rounds = 20
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for id in ids:
+                sxm.get_channel_info(id)
+        indexed = (time.perf_counter() - start) / (rounds * len(ids))
+        # what every segment request used to pay: a scan of the channel list
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for id in ids:
+                next((c for c in channels if c.id == id), None)
+        scanned = (time.perf_counter() - start) / (rounds * len(ids))
+        report("channel lookup", {"channels": len(ids), "indexed_us": indexed * 1e6, "linear_scan_us": scanned * 1e6})
+    finally:
+        server.shutdown()
+
+def bench_playlists(args):
+    fake, server = start_fake(channels=args.channels, latency=args.latency, segment_seconds=args.segment_seconds)
+    sxm = SiriusXM("user", "pass", settings_for(fake))
+    httpd, base = start_proxy(sxm, args.server_mode, args.workers)
+    try:
+        channels = linear_channels(sxm, args.active_channels)
+        def client(n):
+            took, data = timed("{}/listen/{}?quality=256k".format(base, channels[n % len(channels)].id))
+            return [took], len(data)
+        report("playlists ({})".format(args.server_mode), run_clients(args.listeners, args.duration, client))
+        report("upstream", fake.stats()["requests"])
+    finally:
+        httpd.shutdown()
+        server.shutdown()
+
+def bench_segments(args, **overrides):
+    fake, server = start_fake(channels=args.channels, latency=args.latency, segment_seconds=args.segment_seconds, **overrides.pop("fake", {}))
+    sxm = SiriusXM("user", "pass", settings_for(fake, **overrides))
+    httpd, base = start_proxy(sxm, args.server_mode, args.workers)
+    try:
+        channels = linear_channels(sxm, args.active_channels)
+        def client(n):
+            # what a player does: refresh the playlist, then fetch the newest segment
+            channel = channels[n % len(channels)]
+            took, data = timed("{}/listen/{}?quality=256k".format(base, channel.id))
+            segment = [line for line in data.decode().splitlines() if ".aac" in line][-1]
+            took_segment, segdata = timed("{}/listen/{}".format(base, segment))
+            return [took, took_segment], len(data) + len(segdata)
+        results = run_clients(args.listeners, args.duration, client)
+        return fake, sxm, results
+    finally:
+        httpd.shutdown()
+        server.shutdown()
+
+def bench_segment_throughput(args):
+    fake, sxm, results = bench_segments(args)
+    report("segments ({})".format(args.server_mode), results)
+    report("upstream", fake.stats()["requests"])
+    report("segment cache", sxm.segment_cache.stats())
+
+def bench_token_expiry(args):
+    # tokens expire every few seconds while the listeners keep playing
+    ttl = max(3, args.duration / 4)
+    fake, sxm, results = bench_segments(args, token_refresh_ahead=1, fake={"token_ttl": ttl})
+    report("token expiry ttl={}s".format(ttl), results)
+    reauths = {dict(labels)["result"]: value for (name, labels), value in sxm.metrics.counters.items() if name == "sxm_reauth_total"}
+    report("reauth", reauths)
+    report("upstream", fake.stats()["requests"])
+
+def bench_connections(args):
+    # upstream connections opened with the tuned API/CDN pools against a plain
+    # requests.Session (one default pool of 10 per host) as the baseline
+    fake_kwargs = {}
+    workdir = tempfile.mkdtemp()
+    overrides = {}
+    if args.tls:
+        # self-signed stand-in certificate, trusted through ca_bundle
+        cert = os.path.join(workdir, "cert.pem")
+        key = os.path.join(workdir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+        fake_kwargs = {"certfile": cert, "keyfile": key}
+        overrides["ca_bundle"] = cert
+    try:
+        for pools in ("plain", "tuned"):
+            fake, server = start_fake(channels=args.channels, latency=args.latency, segment_seconds=args.segment_seconds, **fake_kwargs)
+            # no segment cache, so every segment fetch goes upstream
+            sxm = SiriusXM("user", "pass", settings_for(fake, segment_cache_mb=0, **overrides))
+            if pools == "plain":
+                sxm.session = requests.Session()
+                sxm.session.headers.update({'User-Agent': sxm.USER_AGENT})
+            httpd, base = start_proxy(sxm, args.server_mode, args.workers)
+            try:
+                channels = linear_channels(sxm, args.active_channels)
+                def client(n):
+                    channel = channels[n % len(channels)]
+                    took, data = timed("{}/listen/{}?quality=256k".format(base, channel.id))
+                    segment = [line for line in data.decode().splitlines() if ".aac" in line][-1]
+                    took_segment, segdata = timed("{}/listen/{}".format(base, segment))
+                    return [took, took_segment], len(data) + len(segdata)
+                results = run_clients(args.listeners, args.duration, client)
+                stats = fake.stats()
+                upstream = sum(stats["requests"].values())
+                report("connections {}{}".format(pools, " (tls)" if args.tls else ""), {"upstream_requests": upstream, "connections_opened": stats["connections"], "requests_per_connection": upstream / max(1, stats["connections"]), "proxy_rps": results["rps"], "p99_ms": results["p99_ms"], "errors": results["errors"]})
+            finally:
+                httpd.shutdown()
+                server.shutdown()
+    finally:
+        shutil.rmtree(workdir)
+
+def bench_decrypt(args):
+    # clear segments served by the proxy vs relayed encrypted, and the CPU each decryption costs
+    for decrypt in (False, True):
+        cpu = time.process_time()
+        fake, sxm, results = bench_segments(args, decrypt_segments=decrypt)
+        cpu = time.process_time() - cpu
+        report("segments decrypt={}".format(decrypt), results)
+        histogram = sxm.metrics.histograms.get(('sxm_decrypt_cpu_seconds', ()))
+        if histogram and histogram[-1]:
+            report("decrypt cpu", {"segments": histogram[-1], "cpu_us_per_segment": histogram[-2] / histogram[-1] * 1e6, "mb_per_cpu_second": sxm.metrics.counters[('sxm_decrypted_bytes_total', ())] / histogram[-2] / 1e6})
+        # the whole process, this includes the load generator and the fake upstream
+        report("process cpu", {"cpu_seconds": cpu, "cpu_ms_per_request": cpu / max(1, results["requests"]) * 1000})
+
+def bench_stream(args):
+    # every listener on one /stream connection; upstream should see one segment stream per channel
+    fake, server = start_fake(channels=args.channels, latency=args.latency, segment_seconds=args.segment_seconds)
+    sxm = SiriusXM("user", "pass", settings_for(fake))
+    httpd, base = start_proxy(sxm, args.server_mode, args.workers)
+    try:
+        channels = linear_channels(sxm, args.active_channels)
+        received = [0] * args.listeners
+        deadline = time.time() + args.duration
+        def listen(n):
+            with urllib.request.urlopen("{}/stream/{}?quality=256k".format(base, channels[n % len(channels)].id), timeout=30) as res:
+                while time.time() < deadline:
+                    data = res.read1(64 * 1024)
+                    if not data:
+                        break
+                    received[n] += len(data)
+        threads = [threading.Thread(target=listen, args=(n,)) for n in range(args.listeners)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        segments = fake.stats()["requests"].get("segment", 0)
+        report("stream", {"listeners": args.listeners, "channels": len(channels), "mb_received": sum(received) / 1e6, "upstream_segments": segments, "upstream_segments_per_channel": segments / len(channels)})
+    finally:
+        httpd.shutdown()
+        server.shutdown()
+
+PREFORK = """
+import json, sys
+from sxm import SiriusXM, make_server, run_prefork
+settings, port, processes, mode, workers = json.loads(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], int(sys.argv[5])
+def start_worker(sock):
+    sxm = SiriusXM("user", "pass", settings)
+    httpd = make_server(sxm, ("127.0.0.1", port), mode, workers, sock)
+    httpd.RequestHandlerClass.log_message = lambda *args: None
+    httpd.serve_forever()
+run_prefork(("127.0.0.1", port), processes, start_worker)
+"""
+
+LOADGEN = """
+import json, sys
+from benchmark import collect, timed
+base, ids, listeners, duration = sys.argv[1], json.loads(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4])
+def client(n):
+    took, data = timed("{}/listen/{}?quality=256k".format(base, ids[n % len(ids)]))
+    return [took], len(data)
+latencies, errors, total, elapsed = collect(listeners, duration, client)
+json.dump({"latencies": latencies, "errors": errors, "bytes": total, "elapsed": elapsed}, sys.stdout)
+"""
+
+def run_load_processes(processes, base, ids, listeners, duration):
+    # one load generating process tops out at what its GIL allows (under 2000
+    # requests/s), well below a few proxy workers, so the listeners are spread
+    # over `processes` of them
+    here = os.path.dirname(os.path.abspath(__file__))
+    procs = [subprocess.Popen([sys.executable, "-c", LOADGEN, base, json.dumps(ids), str(listeners // processes + (n < listeners % processes)), str(duration)], cwd=here, stdout=subprocess.PIPE) for n in range(processes)]
+    results = [json.loads(proc.communicate()[0]) for proc in procs]
+    latencies = [took for result in results for took in result["latencies"]]
+    return summarize(latencies, sum(r["errors"] for r in results), sum(r["bytes"] for r in results), max(r["elapsed"] for r in results))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def bench_processes(args):
+    # the pre-fork launcher with 1 and --processes workers sharing SQLite state,
+    # loaded from --load-processes processes so the client side isn't the limit
+    fake, server = start_fake(channels=args.channels, latency=args.latency, segment_seconds=args.segment_seconds)
+    workdir = tempfile.mkdtemp()
+    try:
+        settings = settings_for(fake, state_backend="sqlite", state_file=os.path.join(workdir, "state.db"))
+        channels = [c["id"] for c in fake.channels if c["type"] == "channel-linear"][:args.active_channels]
+        for processes in sorted({1, args.processes}):
+            port = free_port()
+            base = "http://127.0.0.1:{}".format(port)
+            proc = subprocess.Popen([sys.executable, "-c", PREFORK, json.dumps(settings), str(port), str(processes), args.server_mode, str(args.workers)], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+            try:
+                deadline = time.time() + 30
+                while True:
+                    try:
+                        fetch(base + "/playlist.m3u8")
+                        break
+                    except OSError:
+                        if time.time() > deadline:
+                            raise
+                        time.sleep(0.2)
+                results = run_load_processes(args.load_processes, base, channels, args.listeners, args.duration)
+                report("playlists x{} processes".format(processes), dict(results, load_processes=args.load_processes))
+            finally:
+                proc.terminate()
+                proc.wait()
+        report("upstream", fake.stats()["requests"])
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+SCENARIOS = {
+    "cold": bench_cold_start,
+    "lookup": bench_lookup,
+    "playlists": bench_playlists,
+    "segments": bench_segment_throughput,
+    "expiry": bench_token_expiry,
+    "connections": bench_connections,
+    "processes": bench_processes,
+    "decrypt": bench_decrypt,
+    "stream": bench_stream,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks sxm.py against the local fake SiriusXM upstream")
+    parser.add_argument("scenarios", nargs="*", help="any of {} (default: all)".format(", ".join(SCENARIOS)))
+    parser.add_argument("--listeners", type=int, default=100, help="simulated concurrent listeners")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per load scenario")
+    parser.add_argument("--channels", type=int, default=450)
+    parser.add_argument("--active-channels", type=int, default=10, help="channels the listeners spread over")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the fake upstream adds to every request")
+    parser.add_argument("--segment-seconds", type=int, default=4)
+    parser.add_argument("--server-mode", choices=("threaded", "single"), default="threaded")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--processes", type=int, default=4, help="worker processes for the processes scenario")
+    parser.add_argument("--load-processes", type=int, default=4, help="load generating processes for the processes scenario")
+    parser.add_argument("--tls", action="store_true", help="serve the fake upstream over TLS (needs openssl)")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario {}".format(name))
+    for name in args.scenarios or SCENARIOS:
+        SCENARIOS[name](args)
@@ -0,0 +1,250 @@
+import argparse
+import base64
+import json
+import ssl
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# Local stand-in for the SiriusXM endpoints sxm.py talks to, for load testing
+# without touching the real service. The API lives under /api/ and the CDN
+# under /cdn/, so point sxm.py at it with:
+#   api_url = http://127.0.0.1:<port>/api/{}
+#   cdn_url = http://127.0.0.1:<port>/img/{}
+# Segments are AES-128 encrypted like the real ones when the cryptography
+# package is installed, and served as plain filler otherwise.
+
+VARIANTS = (("32k", 32000), ("64k", 64000), ("96k", 96000), ("256k", 256000))
+ID3_TAG = b'ID3\x04\x00\x00\x00\x00\x00\x3f' + bytes(63)
+
+class FakeSiriusXM:
+    def __init__(self, channels=450, token_ttl=3600, segment_seconds=10, window=6, latency=0.0, segment_scale=1.0):
+        self.token_ttl = token_ttl
+        self.segment_seconds = segment_seconds
+        self.window = window
+        self.latency = latency
+        self.base = None # set once the server is bound
+        self.tokens = {} # token -> expiry
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.connections = 0
+        self.key_id = str(uuid.UUID(int=0xfeed))
+        self.key = bytes(range(16))
+        self.channels = []
+        for number in range(1, channels + 1):
+            self.channels.append({
+                "id": str(uuid.UUID(int=number)),
+                "number": number,
+                "title": "Channel {}".format(number),
+                "genre": ("Pop", "Rock", "Country", "Talk", "Sports")[number % 5],
+                "type": "channel-xtra" if number % 10 == 0 else "channel-linear"
+            })
+        self.by_id = {channel["id"]: channel for channel in self.channels}
+        # one filler block per bitrate behind an ID3 timestamp tag, like real segments open with
+        self.payloads = {name: ID3_TAG + bytes(int(bitrate / 8 * segment_seconds * segment_scale)) for name, bitrate in VARIANTS}
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"connections": self.connections, "requests": dict(self.counts)}
+
+    def issue_token(self):
+        expires = time.time() + self.token_ttl
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": expires}).encode()).decode().rstrip('=')
+        token = "fake.{}.{}".format(payload, uuid.uuid4().hex)
+        with self.lock:
+            self.tokens[token] = expires
+        return token
+
+    def authorized(self, headers):
+        token = headers.get("Authorization", "")[len("Bearer "):]
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and expires > time.time()
+
+    def channel_item(self, channel):
+        return {
+            "entity": {
+                "id": channel["id"],
+                "texts": {"title": {"default": channel["title"]}, "description": {"default": "Fake channel"}},
+                "images": {"tile": {"aspect_1x1": {"preferred": {"url": "logo/{}.png".format(channel["number"]), "width": 300, "height": 300}}}}
+            },
+            "decorations": {"genre": channel["genre"], "channelNumber": str(channel["number"])},
+            "actions": {"play": [{"entity": {"type": channel["type"]}}]}
+        }
+
+    def page(self, offset, limit=50):
+        return [self.channel_item(channel) for channel in self.channels[offset:offset + limit]]
+
+    def master_playlist(self, chid):
+        lines = ["#EXTM3U"]
+        for name, bitrate in VARIANTS:
+            lines.append('#EXT-X-STREAM-INF:BANDWIDTH={},CODECS="mp4a.40.2"'.format(int(bitrate * 1.1)))
+            lines.append("{}/{}_{}_v3.m3u8".format(name, chid, name))
+        return "\n".join(lines) + "\n"
+
+    def media_playlist(self, chid, name):
+        newest = int(time.time() // self.segment_seconds)
+        first = newest - self.window + 1
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:{}".format(self.segment_seconds),
+            "#EXT-X-MEDIA-SEQUENCE:{}".format(first),
+            '#EXT-X-KEY:METHOD=AES-128,URI="{}/api/playback/key/v1/{}"'.format(self.base, self.key_id)
+        ]
+        for seq in range(first, newest + 1):
+            lines.append("#EXTINF:{},".format(self.segment_seconds))
+            lines.append("{}_{}_{}.aac".format(chid, name, seq))
+        return "\n".join(lines) + "\n"
+
+    def segment(self, name):
+        data = self.payloads.get(name.split("_")[1], self.payloads["256k"])
+        if Cipher is None:
+            return data
+        # no IV in the key line, so it's the media sequence number; PKCS7 padded
+        sequence = int(name.rsplit("_", 1)[1].split(".")[0])
+        pad = 16 - len(data) % 16
+        encryptor = Cipher(algorithms.AES(self.key), modes.CBC(sequence.to_bytes(16, 'big'))).encryptor()
+        return encryptor.update(data + bytes([pad]) * pad) + encryptor.finalize()
+
+def make_fake_handler(fake):
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            with fake.lock:
+                fake.connections += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body=b'', content_type='application/json'):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            elif isinstance(body, dict):
+                body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                data = {}
+            path = self.path.split('?')[0]
+            if path == '/api/device/v1/devices':
+                fake.count('device')
+                return self.reply(200, {"grant": fake.issue_token()})
+            if path == '/api/session/v1/sessions/anonymous':
+                fake.count('anonymous')
+                return self.reply(200, {"accessToken": fake.issue_token()})
+            if not fake.authorized(self.headers):
+                fake.count('unauthorized')
+                return self.reply(401, {"error": "unauthorized"})
+            if path == '/api/identity/v1/identities/authenticate/password':
+                fake.count('password')
+                return self.reply(200, {"grant": fake.issue_token()})
+            if path == '/api/session/v1/sessions/authenticated':
+                fake.count('authenticated')
+                return self.reply(200, {"sessionType": "authenticated", "accessToken": fake.issue_token()})
+            if path.startswith('/api/browse/v1/pages/curated-grouping/') and '/containers/' in path:
+                fake.count('browse_page')
+                offset = data["sets"]["5mqCLZ21qAwnufKT8puUiM"]["pagination"]["offset"]["setItemsOffset"]
+                return self.reply(200, {"container": {"sets": [{"items": fake.page(offset)}]}})
+            if path.startswith('/api/browse/v1/pages/curated-grouping/'):
+                fake.count('browse')
+                return self.reply(200, {"page": {"containers": [{"sets": [{"items": fake.page(0), "pagination": {"offset": {"size": len(fake.channels)}}}]}]}})
+            if path in ('/api/playback/play/v1/tuneSource', '/api/playback/play/v1/peek'):
+                fake.count('tune' if path.endswith('tuneSource') else 'peek')
+                channel = fake.by_id.get(data.get("id"))
+                if channel is None:
+                    return self.reply(404, {"error": "unknown channel"})
+                chid = "ch{}".format(channel["number"])
+                stream = {"urls": [{"url": "{}/cdn/{}/v3/{}_master.m3u8".format(fake.base, chid, chid)}]}
+                if channel["type"] == "channel-xtra":
+                    stream["metadata"] = {"xtra": {"sourceContextId": uuid.uuid4().hex}}
+                return self.reply(200, {"streams": [stream]})
+            return self.reply(404, {"error": "not found"})
+
+        def do_GET(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            path = self.path.split('?')[0]
+            if path == '/_stats':
+                return self.reply(200, fake.stats())
+            if not fake.authorized(self.headers):
+                fake.count('unauthorized')
+                return self.reply(401, {"error": "unauthorized"})
+            if path.startswith('/api/playback/key/v1/'):
+                fake.count('key')
+                return self.reply(200, {"key": base64.b64encode(fake.key).decode()})
+            parts = path.split('/')
+            # /cdn/<chid>/v3/<chid>_master.m3u8, /cdn/<chid>/v3/<q>/<playlist>.m3u8, /cdn/<chid>/v3/<q>/<seg>.aac
+            if path.startswith('/cdn/') and path.endswith('_master.m3u8'):
+                fake.count('master')
+                return self.reply(200, fake.master_playlist(parts[2]), 'application/x-mpegURL')
+            if path.startswith('/cdn/') and path.endswith('.m3u8'):
+                fake.count('variant')
+                return self.reply(200, fake.media_playlist(parts[2], parts[4]), 'application/x-mpegURL')
+            if path.startswith('/cdn/') and path.endswith('.aac'):
+                fake.count('segment')
+                return self.reply(200, fake.segment(parts[-1]), 'audio/aac')
+            return self.reply(404, {"error": "not found"})
+    return FakeHandler
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    # clients going away mid-request (killed workers, benchmark teardown) are expected
+    def handle_error(self, request, client_address):
+        pass
+
+def start_fake(port=0, certfile=None, keyfile=None, **kwargs):
+    # starts the stand-in on a background thread, returns (fake, server)
+    fake = FakeSiriusXM(**kwargs)
+    server = QuietHTTPServer(('127.0.0.1', port), make_fake_handler(fake))
+    server.daemon_threads = True
+    scheme = "http"
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    fake.base = "{}://127.0.0.1:{}".format(scheme, server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return fake, server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the SiriusXM API and streaming CDN")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--channels", type=int, default=450)
+    parser.add_argument("--token-ttl", type=float, default=3600, help="seconds until issued tokens expire")
+    parser.add_argument("--segment-seconds", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--cert", help="serve TLS with this certificate (PEM)")
+    parser.add_argument("--key", help="private key for --cert")
+    args = parser.parse_args()
+    fake, server = start_fake(args.port, args.cert, args.key, channels=args.channels, token_ttl=args.token_ttl, segment_seconds=args.segment_seconds, latency=args.latency)
+    print("Fake SiriusXM at {}".format(fake.base))
+    print("  api_url = {}/api/{{}}".format(fake.base))
+    print("  cdn_url = {}/img/{{}}".format(fake.base))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
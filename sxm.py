@@ -1,39 +1,1087 @@
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import socket
+import signal
+import sqlite3
 import base64
 import urllib.parse
 import json
 import time, datetime
 import sys
+import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 config = configparser.ConfigParser()
 import random
+import re
+import mmap
+import gzip
+import hashlib
+import heapq
 import threading
+import queue
+import traceback
+from contextlib import contextmanager
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+try:
+    # optional, only needed for decrypt_segments
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+class LRUCache:
+    # Bounded in-memory cache with a byte budget, LRU + TTL eviction and
+    # coalescing of concurrent misses on the same key: only the first caller
+    # runs the fetch, every other caller waits on it and gets the same result.
+    def __init__(self, max_bytes, ttl, sizeof=len, max_entries=None, wait_timeout=60):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.sizeof = sizeof
+        self.entries = OrderedDict() # key -> (expires, size, value)
+        self.inflight = {} # key -> [event, value]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._remove(key)
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes or (self.max_entries and len(self.entries) > self.max_entries):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+    def begin(self, key):
+        # Returns (value, None) on a hit, or once another caller's fetch of the
+        # key is done (None if that took over wait_timeout). Returns (None, token)
+        # when the caller is the one that has to fetch it; it must then hand the
+        # result to finish().
+        with self.lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value, None
+            self.misses += 1
+            waiting = self.inflight.get(key)
+            if waiting is None:
+                waiting = self.inflight[key] = [threading.Event(), None]
+                return None, waiting
+        if not waiting[0].wait(self.wait_timeout):
+            return None, None
+        return waiting[1], None
+
+    def finish(self, key, token, value):
+        if value:
+            self.put(key, value)
+        token[1] = value
+        with self.lock:
+            del self.inflight[key]
+        token[0].set()
+
+    def get_or_fetch(self, key, fetch):
+        value, token = self.begin(key)
+        if token is None:
+            return value
+        value = None
+        try:
+            value = fetch()
+        finally:
+            self.finish(key, token, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class TunerStore:
+    # Thread safe store of tuned stream info. Every entry has a TTL, the store
+    # has a hard size cap with LRU eviction, and expired entries are swept off
+    # an expiry heap instead of scanning everything.
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> [expires, value, stored, last used]
+        self.heap = [] # (expires, key), stale items are skipped when popped
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            if entry[0] <= now:
+                del self.entries[key]
+                return None
+            entry[3] = now
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        now = time.time()
+        expires = now + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = [expires, value, now, now]
+            heapq.heappush(self.heap, (expires, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def cleanup(self):
+        now = time.time()
+        removed = 0
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires, key = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] == expires:
+                    del self.entries[key]
+                    removed += 1
+            # re-puts and LRU evictions leave stale heap items behind, drop them when they pile up
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [(entry[0], key) for key, entry in self.entries.items()]
+                heapq.heapify(self.heap)
+        return removed
+
+    def expiring(self, within):
+        # keys that expire within `within` seconds and were used since they were stored
+        deadline = time.time() + within
+        with self.lock:
+            return [key for key, entry in self.entries.items() if entry[0] <= deadline and entry[3] > entry[2]]
+
+class NullState:
+    # The state backend is an optional mirror of the channel catalog, tuned
+    # streams, Xtra sessions, the session token and AES keys, shared between
+    # worker processes. A single process already keeps all of it in its own
+    # bounded stores (TunerStore, LRUCache), so by default there is no mirror:
+    # this backend holds nothing and every read misses.
+    def get(self, namespace, key):
+        return None
+
+    def put(self, namespace, key, value, ttl=None):
+        pass
+
+    def delete(self, namespace, key):
+        pass
+
+class SQLiteState:
+    # State shared between worker processes on one host through one SQLite
+    # file in WAL mode, which needs a local disk (WAL doesn't work over network
+    # filesystems). Values are stored as JSON, bytes are wrapped as base64.
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value TEXT, expires REAL, PRIMARY KEY (namespace, key))")
+
+    def connection(self):
+        # sqlite connections can't be shared across threads, keep one per thread
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA busy_timeout=10000")
+        return db
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bytes):
+            return json.dumps({"__bytes__": base64.b64encode(value).decode("ascii")})
+        return json.dumps(value)
+
+    @staticmethod
+    def decode(value):
+        value = json.loads(value)
+        if isinstance(value, dict) and "__bytes__" in value:
+            return base64.b64decode(value["__bytes__"])
+        return value
+
+    def get(self, namespace, key):
+        row = self.connection().execute("SELECT value, expires FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return self.decode(row[0])
+
+    def put(self, namespace, key, value, ttl=None):
+        db = self.connection()
+        db.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)", (namespace, key, self.encode(value), time.time() + ttl if ttl else None))
+        # sweep now and then instead of running a cleanup thread in every worker
+        if random.random() < 0.01:
+            db.execute("DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def delete(self, namespace, key):
+        self.connection().execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+class Metrics:
+    # Prometheus style counters, gauges and latency histograms, rendered in the
+    # text exposition format by the /metrics route
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = {} # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = [] # callables returning extra (name, type, labels, value) samples
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels={}, amount=1):
+        key = (name, self.labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge_add(self, name, labels={}, amount=1):
+        key = (name, self.labels(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, self.labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.perf_counter() - start)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        typed = set()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        # every sample of a family has to be contiguous, collectors report theirs
+        # source by source, so gather everything per name before writing it out
+        families = OrderedDict() # name -> (type, [(labels, value)])
+        def sample(name, kind, labels, value):
+            families.setdefault(name, (kind, []))[1].append((labels, value))
+        for (name, labels), value in counters:
+            sample(name, 'counter', labels, value)
+        for (name, labels), value in gauges:
+            sample(name, 'gauge', labels, value)
+        for collector in self.collectors:
+            for name, kind, labels, value in collector():
+                sample(name, kind, self.labels(labels), value)
+        for name, (kind, samples) in families.items():
+            typed.add(name)
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, self.format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels + (('le', bound),)), count))
+            lines.append('{}_bucket{} {}'.format(name, self.format_labels(labels + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('{}_sum{} {}'.format(name, self.format_labels(labels), histogram[-2]))
+            lines.append('{}_count{} {}'.format(name, self.format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+class SamplingProfiler:
+    # Samples the stacks of every thread at a fixed interval while running, and
+    # reports them in the folded "frame;frame;frame count" format flame graph tools read
+    def __init__(self):
+        self.stacks = {}
+        self.running = None
+
+    def start(self, interval=0.01):
+        if self.running is not None:
+            return False
+        self.stacks = {}
+        self.running = threading.Event()
+        threading.Thread(target=self.run, args=(self.running, interval), daemon=True).start()
+        return True
+
+    def stop(self):
+        if self.running is not None:
+            self.running.set()
+            self.running = None
+        return '\n'.join('{} {}'.format(stack, count) for stack, count in sorted(self.stacks.items(), key=lambda x: -x[1])) + '\n'
+
+    def run(self, stopped, interval):
+        me = threading.get_ident()
+        while not stopped.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = ';'.join('{}:{}'.format(f.name, f.lineno) for f in traceback.extract_stack(frame))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+def parse_media_segments(data):
+    # returns the target duration and, per .aac segment, its name, duration,
+    # media sequence number and the EXT-X-KEY line that applies to it
+    targetduration = 10
+    sequence = 0
+    duration = 0
+    key = None
+    segments = []
+    for line in data.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            try:
+                targetduration = int(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            try:
+                sequence = int(line.split(":", 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-KEY:"):
+            key = line
+        elif line.startswith("#EXTINF:"):
+            try:
+                duration = float(line[8:].split(",", 1)[0])
+            except ValueError:
+                duration = targetduration
+        elif line.endswith(".aac"):
+            segments.append({"name": line, "duration": duration or targetduration, "sequence": sequence, "key": key})
+            sequence += 1
+            duration = 0
+    return targetduration, segments
+
+def strip_id3(data):
+    # HLS audio segments open with an ID3 tag (timestamps) that has no place
+    # in a continuous ADTS stream; returns a view of the audio after it
+    view = memoryview(data)
+    while len(view) >= 10 and view[:3] == b'ID3':
+        size = (view[6] << 21) | (view[7] << 14) | (view[8] << 7) | view[9]
+        view = view[size + (20 if view[5] & 0x10 else 10):]
+    return view
+
+class TimeShiftBuffer:
+    # Time-shift window of one stream on local disk: a file of fixed size slots,
+    # memory-mapped and used as a ring, plus an in-memory index of which segment
+    # sits in which slot. Reads copy the slot out under the lock, so a writer
+    # wrapping around onto it can't change a segment while it's being sent.
+    def __init__(self, path, slots, slot_size, targetduration):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.targetduration = targetduration
+        self.file = open(path, 'w+b')
+        self.file.truncate(slots * slot_size)
+        self.map = mmap.mmap(self.file.fileno(), slots * slot_size)
+        self.index = OrderedDict() # seq -> (slot, length, name, duration, key line)
+        self.names = {} # upstream segment name -> seq
+        self.next_seq = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def add(self, name, data, duration, key):
+        if len(data) > self.slot_size:
+            return False
+        with self.lock:
+            if self.closed or name in self.names:
+                return False
+            seq = self.next_seq
+            self.next_seq += 1
+            slot = seq % self.slots
+            # whatever lived in this slot falls out of the window
+            old = self.index.pop(seq - self.slots, None)
+            if old is not None:
+                del self.names[old[2]]
+            offset = slot * self.slot_size
+            self.map[offset:offset + len(data)] = data
+            self.index[seq] = (slot, len(data), name, duration, key)
+            self.names[name] = seq
+            return True
+
+    def read(self, seq):
+        with self.lock:
+            entry = self.index.get(seq)
+            if entry is None or self.closed:
+                return None
+            offset = entry[0] * self.slot_size
+            return self.map[offset:offset + entry[1]]
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.index.clear()
+            self.names.clear()
+            self.map.close()
+            self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def entries(self):
+        with self.lock:
+            return list(self.index.items())
+
+class SegmentRelay:
+    # Body of an upstream segment response, relayed in chunks as it arrives
+    # while the segment cache fills alongside. Reads go into one reusable buffer
+    # and out as views of it, the only copy made is the one the cache keeps.
+    # close() always settles the cache entry, also when the client left before
+    # the body started, so nobody waiting on it hangs.
+    def __init__(self, res, cache, key, token, chunk_size=64*1024):
+        self.res = res
+        self.cache = cache
+        self.key = key
+        self.token = token
+        self.chunk_size = chunk_size
+        length = res.headers.get('Content-Length')
+        self.length = int(length) if length else None
+        self.body = bytearray()
+        self.done = False
+
+    def __iter__(self):
+        buf = bytearray(self.chunk_size)
+        view = memoryview(buf)
+        while not self.done:
+            try:
+                n = self.res.raw.readinto(buf)
+            except Exception:
+                # upstream broke off, what came so far isn't the segment
+                self.finish(False)
+                raise
+            if not n:
+                self.finish(self.whole())
+                return
+            self.body += view[:n]
+            yield view[:n]
+
+    def close(self):
+        if self.done:
+            return
+        # the client went away, finish the download for the cache and anyone waiting on it
+        complete = False
+        try:
+            self.body += self.res.raw.read()
+            complete = self.whole()
+        except Exception:
+            pass
+        self.finish(complete)
+
+    def whole(self):
+        # a body cut short of its Content-Length is never cached
+        return self.length is None or len(self.body) == self.length
+
+    def finish(self, complete):
+        if self.done:
+            return
+        self.done = True
+        self.res.close()
+        self.cache.finish(self.key, self.token, bytes(self.body) if complete else None)
+
+class EncodedBody:
+    # A response body kept ready to send: the bytes, their ETag and, once a
+    # client asked for it, the gzipped bytes
+    def __init__(self, raw):
+        self.raw = raw
+        self.etag = '"{}"'.format(hashlib.sha1(raw).hexdigest())
+        self._gzipped = None
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.raw, 6)
+        return self._gzipped
+
+def accepts_gzip(header):
+    # Accept-Encoding read as codings with q-values: gzip is sent when it, or *
+    # without gzip named, comes with a q above 0
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings.get('gzip', codings.get('*', 0)) > 0
+
+class MediaPlaylist:
+    # Latest rewritten media playlist of one stream. It is kept pre-split around
+    # the per-client sessionId, so serving it to an Xtra listener is one join.
+    KEEP_ENTRIES = 64
+
+    def __init__(self):
+        self.pieces = None
+        self.plain = None
+        self.segments = []
+        self.entries = {} # segment name -> parsed entry, kept a while after it leaves the window
+        self.last_seen = time.time()
+        self.ready = threading.Event()
+
+    def update(self, pieces, entries):
+        self.pieces = pieces
+        self.plain = EncodedBody(b''.join(pieces))
+        self.segments = entries
+        for entry in entries:
+            self.entries[entry["name"]] = entry
+        for name in list(self.entries)[:-self.KEEP_ENTRIES]:
+            del self.entries[name]
+
+    def render(self, sessionId=''):
+        if self.pieces is None:
+            return None
+        if sessionId == '':
+            return self.plain
+        return EncodedBody(sessionId.encode('utf-8').join(self.pieces))
+
+class PlaylistPoller:
+    # One upstream poller per media playlist, fanned out to every listener.
+    # Each poller re-reads its playlist on the HLS target duration cadence, keeps
+    # the rewritten bytes ready to serve and pulls the newest `segments` into the
+    # segment cache. A poller stops once nobody asked for it for `idle` seconds.
+    def __init__(self, sxm, segments, idle):
+        self.sxm = sxm
+        self.segments = segments
+        self.idle = idle
+        self.playlists = {} # (id, base_url, quality) -> MediaPlaylist
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(id, streaminfo):
+        return (id, streaminfo["base_url"], streaminfo["quality"])
+
+    def get(self, id, streaminfo, sessionId='', timeout=15):
+        key = self.key(id, streaminfo)
+        with self.lock:
+            playlist = self.playlists.get(key)
+            if playlist is None:
+                playlist = self.playlists[key] = MediaPlaylist()
+                threading.Thread(target=self.run, args=(key, id, streaminfo), daemon=True).start()
+            playlist.last_seen = time.time()
+        # only the very first listener of a stream waits on the network
+        playlist.ready.wait(timeout)
+        return playlist.render(sessionId)
+
+    def touch(self, id, streaminfo):
+        playlist = self.playlists.get(self.key(id, streaminfo))
+        if playlist is not None:
+            playlist.last_seen = time.time()
+
+    def window(self, id, streaminfo):
+        # parsed entries of the current playlist window, oldest first
+        self.get(id, streaminfo)
+        playlist = self.playlists.get(self.key(id, streaminfo))
+        return playlist.segments if playlist is not None else []
+
+    def entry(self, id, streaminfo, seg):
+        # key line and media sequence of a segment as last polled, starting a poller if needed
+        self.get(id, streaminfo)
+        playlist = self.playlists.get(self.key(id, streaminfo))
+        return playlist.entries.get(seg) if playlist is not None else None
+
+    def run(self, key, id, streaminfo):
+        playlist = self.playlists[key]
+        while True:
+            with self.lock:
+                if time.time() - playlist.last_seen > self.idle:
+                    del self.playlists[key]
+                    # nobody follows this rendition any more, a later resume starts a fresh window
+                    if not any(k[0] == id and k[2] == key[2] for k in self.playlists):
+                        self.sxm.timeshift_close(id, streaminfo["HLS"])
+                    return
+            delay = 5
+            data = None
+            try:
+                data = self.sxm.fetch_media_playlist(streaminfo)
+                if data:
+                    targetduration, entries = parse_media_segments(data)
+                    playlist.update(self.sxm.rewrite_media_playlist(id, data, streaminfo["HLS"]), entries)
+                    # poll at half the target duration so new segments show up early
+                    delay = max(1, targetduration / 2)
+                else:
+                    self.sxm.log("failed to fetch AAC stream list")
+            except Exception as e:
+                self.sxm.log("Playlist poll of {} failed: {}".format(id, e))
+            playlist.ready.set()
+            if data and self.segments > 0:
+                self.prefetch(streaminfo, entries[-self.segments:])
+            if data and self.sxm.timeshift_minutes > 0:
+                try:
+                    self.sxm.timeshift_record(id, streaminfo, targetduration, entries)
+                except Exception as e:
+                    self.sxm.log("Time-shift of {} failed: {}".format(id, e))
+            time.sleep(delay)
+
+    def prefetch(self, streaminfo, entries):
+        for entry in entries:
+            try:
+                self.sxm.fetch_segment(streaminfo, entry["name"], entry)
+            except Exception as e:
+                self.sxm.log("Prefetch of {} failed: {}".format(entry["name"], e))
+
+class StreamListener:
+    # One /stream client: a bounded queue of segments, written to its socket
+    # by a thread of its own
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+    def __iter__(self):
+        while not self.dropped:
+            try:
+                data = self.queue.get(timeout=self.stream.stall_timeout)
+            except queue.Empty:
+                # nothing new upstream for a long while, let the client reconnect
+                return
+            yield data
+
+    def send(self, sock, timeout):
+        metrics = self.stream.sxm.metrics
+        try:
+            sock.settimeout(timeout)
+            for data in self:
+                sock.sendall(data)
+                metrics.inc('sxm_bytes_served_total', {'channel': self.stream.id}, len(data))
+        except OSError:
+            pass
+        finally:
+            self.stream.remove(self)
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+class ChannelStream:
+    # Continuous ADTS stream of one channel rendition for /stream listeners. A
+    # single reader follows the playlist poller, takes each new segment clear
+    # from the segment cache and fans it out to every listener's queue; a
+    # listener whose queue is full is dropped instead of holding up the rest.
+    # The reader stops with its last listener.
+    def __init__(self, sxm, id, quality, streaminfo, buffer_segments, start_segments, stall_timeout):
+        self.sxm = sxm
+        self.id = id
+        self.quality = quality
+        self.streaminfo = streaminfo
+        self.buffer_segments = buffer_segments
+        self.start_segments = start_segments
+        self.stall_timeout = stall_timeout
+        self.listeners = set()
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            if self.stopped:
+                return None
+            listener = StreamListener(self, self.buffer_segments)
+            self.listeners.add(listener)
+        self.sxm.metrics.gauge_add('sxm_stream_listeners', {'channel': self.id}, 1)
+        return listener
+
+    def remove(self, listener):
+        with self.lock:
+            if listener not in self.listeners:
+                return
+            self.listeners.discard(listener)
+        self.sxm.metrics.gauge_add('sxm_stream_listeners', {'channel': self.id}, -1)
+
+    def publish(self, data):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener.queue.put_nowait(data)
+            except queue.Full:
+                listener.dropped = True
+                self.remove(listener)
+                self.sxm.metrics.inc('sxm_stream_dropped_total', {'channel': self.id})
+
+    def run(self):
+        last = None
+        while True:
+            with self.lock:
+                if not self.listeners:
+                    self.stopped = True
+                    return
+            try:
+                if not self.streaminfo.get("sessionId"):
+                    # linear tunes are renewed by maintain_tuners, follow them
+                    current = self.sxm.get_tuner(self.id)
+                    if current:
+                        self.streaminfo = self.sxm.rendition(current, self.quality)
+                entries = self.sxm.poller.window(self.id, self.streaminfo)
+                if last is None:
+                    # start a few segments behind live so players fill their buffer at once
+                    entries = entries[-self.start_segments:]
+                for entry in entries:
+                    if last is not None and entry["sequence"] <= last:
+                        continue
+                    data = self.sxm.fetch_segment(self.streaminfo, entry["name"], entry, clear=True)
+                    if data:
+                        self.publish(strip_id3(data))
+                    last = entry["sequence"]
+            except Exception as e:
+                self.sxm.log("Stream of {} failed: {}".format(self.id, e))
+            time.sleep(1)
+
+class Channel:
+    # Compact per-channel record; the logo url and M3U entry are built once
+    M3U_ENTRY = """#EXTINF:-1 tvg-id="{}" tvg-logo="{}" group-title="{}",{}\n{}"""
+    __slots__ = ("id", "title", "description", "genre", "channel_id", "channel_type", "logo", "url", "m3u")
+
+    def __init__(self, id, title, description, genre, channel_id, channel_type, logo):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.genre = genre
+        self.channel_id = channel_id
+        self.channel_type = channel_type
+        self.logo = logo
+        self.url = "/listen/{}".format(id)
+        #TODO: Work on finding the proper M3U8 metadata needed.
+        self.m3u = self.M3U_ENTRY.format(channel_id, logo, genre, title, self.url)
+
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "description": self.description,
+            "genre": self.genre,
+            "channel_id": self.channel_id,
+            "channel_type": self.channel_type,
+            "logo": self.logo,
+            "id": self.id
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data["title"], data["description"], data["genre"], data["channel_id"], data["channel_type"], data["logo"])
+
+class ChannelCatalog:
+    # The channel list in channel-number order, indexed by entity id, channel
+    # number (for urls naming a channel by number), genre and type.
+    TYPES = {"linear": "channel-linear", "xtra": "channel-xtra"}
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.by_id = {channel.id: channel for channel in channels}
+        self.by_number = {str(channel.channel_id): channel for channel in channels}
+        self.by_genre = {}
+        self.by_type = {}
+        for channel in channels:
+            self.by_genre.setdefault(channel.genre.lower(), []).append(channel)
+            self.by_type.setdefault(channel.channel_type, []).append(channel)
+        self.position = {channel.id: i for i, channel in enumerate(channels)}
+        # rendered filtered playlists/EPGs, dropped together with the catalog
+        self.views = {}
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+    @staticmethod
+    def number(channel):
+        try:
+            return int(channel.channel_id)
+        except (TypeError, ValueError):
+            return None
+
+    def select(self, genres=None, types=None, ranges=None, ids=None):
+        # channels matching every given filter, in channel-number order.
+        # Each filter is a list and matches any of its values.
+        selected = None
+        def narrow(matches):
+            ids = {channel.id for channel in matches}
+            return ids if selected is None else selected & ids
+        if genres:
+            selected = narrow(c for genre in genres for c in self.by_genre.get(genre.lower(), []))
+        if types:
+            selected = narrow(c for t in types for c in self.by_type.get(self.TYPES.get(t, t), []))
+        if ids:
+            selected = narrow(self.by_id[id] for id in ids if id in self.by_id)
+        if ranges:
+            selected = narrow(c for c in self.channels if self.number(c) is not None and any(low <= self.number(c) <= high for low, high in ranges))
+        if selected is None:
+            return list(self.channels)
+        return sorted((self.by_id[id] for id in selected), key=lambda c: self.position[c.id])
+
+class AuthManager:
+    # Owns the bearer token of the session. It tracks when the token expires,
+    # refreshes it ahead of time in the background and makes concurrent callers
+    # that hit an expired token wait on one shared re-login, after which they
+    # replay their request. Callers that waited on a failed re-login get its
+    # result, and the next attempt is held back for a growing backoff.
+    def __init__(self, sxm, lifetime, refresh_ahead, backoff, max_backoff):
+        self.sxm = sxm
+        self.lifetime = lifetime
+        self.refresh_ahead = refresh_ahead
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.generation = 0 # bumped after every successful (re)login
+        self.attempts = 0 # bumped after every re-login, successful or not
+        self.result = True # of the last re-login
+        self.failures = 0 # re-logins failed in a row
+        self.retry_at = 0
+        self.expires = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @staticmethod
+    def token_expiry(token):
+        # the tokens are JWTs, read "exp" when it's there
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
+
+    def token_received(self, token):
+        expires = self.token_expiry(token)
+        self.expires = expires if expires else time.time() + self.lifetime
+
+    def ensure(self):
+        if self.sxm.is_session_authenticated() and time.time() < self.expires:
+            return True
+        return self.refresh(self.generation)
+
+    def refresh(self, generation):
+        # `generation` is what the caller saw before its request failed; if it
+        # moved on meanwhile another thread already did the re-login for us
+        attempt = self.attempts
+        with self.lock:
+            if generation != self.generation and self.sxm.is_session_authenticated():
+                return True
+            if self.adopt_shared():
+                return True
+            # a re-login finished while we waited on the lock, its result is ours too
+            if attempt != self.attempts:
+                return self.result
+            if time.time() < self.retry_at:
+                return False
+            self.sxm.log("Refreshing session")
+            # log in on the side, requests in flight keep the current token meanwhile
+            session = self.sxm.new_session()
+            ok = self.sxm.login(session) and self.sxm.authenticate(session)
+            self.sxm.metrics.inc('sxm_reauth_total', {'result': 'ok' if ok else 'failed'})
+            self.attempts += 1
+            self.result = ok
+            if ok:
+                self.failures = 0
+                self.retry_at = 0
+                self.sxm.session.cookies = session.cookies
+                self.sxm.session.headers["Authorization"] = session.headers["Authorization"]
+                self.token_received(session.headers["Authorization"][len("Bearer "):])
+                self.generation += 1
+                self.sxm.state.put("auth", "token", {"authorization": self.sxm.session.headers["Authorization"], "expires": self.expires}, max(1, self.expires - time.time()))
+            else:
+                self.failures += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+                self.retry_at = time.time() + delay
+                self.sxm.log("Session refresh failed, next attempt in {:.0f}s".format(delay))
+            self.wakeup.set()
+            return ok
+
+    def adopt_shared(self):
+        # another worker process may have refreshed already, use its token
+        shared = self.sxm.state.get("auth", "token")
+        if not shared or shared["authorization"] == self.sxm.session.headers.get("Authorization"):
+            return False
+        if shared["expires"] - self.refresh_ahead <= time.time():
+            return False
+        self.sxm.session.headers["Authorization"] = shared["authorization"]
+        self.expires = shared["expires"]
+        self.generation += 1
+        self.wakeup.set()
+        return True
+
+    def run(self):
+        while True:
+            delay = 60
+            if self.expires:
+                delay = self.expires - self.refresh_ahead - time.time()
+                if delay <= 0:
+                    if not self.refresh(self.generation):
+                        self.sxm.log("Background session refresh failed")
+                    delay = 60
+            self.wakeup.wait(max(delay, 5))
+            self.wakeup.clear()
+
+class KeepAliveAdapter(HTTPAdapter):
+    # HTTPAdapter whose pooled connections turn on TCP keep-alive, so idle
+    # connections to the API and CDN survive NATs between playlist refreshes
+    def __init__(self, keepalive=True, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs["socket_options"] = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
 
 class SiriusXM:
     USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36'
     REST_FORMAT = 'https://api.edge-gateway.siriusxm.com/{}'
     CDN_URL = "https://imgsrv-sxm-prod-device.streaming.siriusxm.com/{}"
+    AUTH_FAILURES = (401, 403) # other 4xx (a segment gone from the window, an unknown key) aren't the token's fault
 
-    def __init__(self, username, password):
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': self.USER_AGENT})
+    def __init__(self, username, password, settings=None):
+        self.settings = settings
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self.cache_metrics)
+        self.profiler = SamplingProfiler() if self.setting("profiler", False) else None
+        # upstream base urls, overridable to point at a stand-in (see fakexm.py)
+        self.REST_FORMAT = self.setting("api_url", self.REST_FORMAT)
+        self.CDN_URL = self.setting("cdn_url", self.CDN_URL)
+        self.session = self.make_session()
+        if self.setting("state_backend", "none") == "sqlite":
+            self.state = SQLiteState(self.setting("state_file", "state.db"))
+        else:
+            self.state = NullState()
         self.username = username
         self.password = password
         self.playlists = {}
         self.channels = None
         self.channel_ref = None
         self.m3u8dat = None
-        self.stream_urls = {}
-        self.xtra_streams = {}
+        # channel id -> latest stream info, and Xtra sessionId -> its stream info
+        self.stream_urls = TunerStore(self.setting("tuner_ttl", 3600), self.setting("tuner_max_entries", 1000))
+        self.xtra_streams = TunerStore(self.setting("xtra_session_ttl", 600), self.setting("xtra_max_sessions", 5000))
+        self.tuner_refresh_ahead = self.setting("tuner_refresh_ahead", 120)
         self.prevcount = 0
-        threading.Thread(target=self.cleanup_streaminfo, daemon=True).start()
+        self.auth = AuthManager(self, self.setting("token_lifetime", 3600), self.setting("token_refresh_ahead", 300), self.setting("auth_retry_backoff", 5.0), self.setting("auth_retry_backoff_max", 300.0))
+        self.catalog_lock = threading.Lock()
+        self.tune_locks = {}
+        self.catalog_cache = self.setting("catalog_cache", "channels.json")
+        self.catalog_refresh = self.setting("catalog_refresh", 86400)
+        self.load_catalog()
+        threading.Thread(target=self.refresh_catalog_loop, daemon=True).start()
+        self.segment_cache = LRUCache(self.setting("segment_cache_mb", 64) * 1024 * 1024, self.setting("segment_cache_ttl", 300))
+        self.key_cache = LRUCache(1024 * 1024, self.setting("key_cache_ttl", 3600), max_entries=self.setting("key_cache_size", 64))
+        self.stream_segments = self.setting("stream_segments", True)
+        self.decrypt = self.setting("decrypt_segments", False)
+        if self.decrypt and Cipher is None:
+            self.log("decrypt_segments needs the cryptography package, serving encrypted segments")
+            self.decrypt = False
+        self.default_quality = self.setting("default_quality", "256k")
+        self.master_playlist = self.setting("master_playlist", True)
+        self.timeshift_minutes = self.setting("timeshift_minutes", 0)
+        self.timeshift_dir = self.setting("timeshift_dir", "timeshift")
+        self.timeshift_slot_size = self.setting("timeshift_slot_kb", 512) * 1024
+        self.recordings_dir = self.setting("recordings_dir", "recordings")
+        self.timeshift = {} # (id, HLS tag) -> TimeShiftBuffer
+        self.timeshift_recorded = {} # (id, HLS tag) -> Event set once the poller filled the ring
+        self.timeshift_lock = threading.Lock()
+        self.poller = PlaylistPoller(self, self.setting("prefetch_segments", 3), self.setting("prefetch_idle", 60))
+        self.streams = {} # (id, rendition) -> ChannelStream
+        self.streams_lock = threading.Lock()
+        self.stream_buffer_segments = self.setting("stream_buffer_segments", 4)
+        self.stream_start_segments = self.setting("stream_start_segments", 2)
+        self.stream_send_timeout = self.setting("stream_send_timeout", 30)
+        threading.Thread(target=self.maintain_tuners, daemon=True).start()
     
+    def make_session(self):
+        # separate pools for the API gateway and the streaming CDN, so segment
+        # fetches can't starve tune/auth calls. Stream hosts vary, so the CDN
+        # pool is mounted for everything that isn't the API.
+        session = requests.Session()
+        session.headers.update({'User-Agent': self.USER_AGENT})
+        # passed per request, a session level verify loses against REQUESTS_CA_BUNDLE
+        self.verify = self.setting("ca_bundle", "") or True
+        retries = Retry(total=self.setting("retries", 2), backoff_factor=self.setting("retry_backoff", 0.3), status_forcelist=(502, 503, 504), raise_on_status=False)
+        keepalive = self.setting("tcp_keepalive", True)
+        block = self.setting("pool_block", False)
+        cdn = KeepAliveAdapter(keepalive, pool_connections=4, pool_maxsize=self.setting("cdn_pool_size", 64), pool_block=block, max_retries=retries)
+        session.mount("https://", cdn)
+        session.mount("http://", cdn)
+        session.mount(self.REST_FORMAT.format(""), KeepAliveAdapter(keepalive, pool_connections=1, pool_maxsize=self.setting("api_pool_size", 16), pool_block=block, max_retries=retries))
+        self.api_timeout = (self.setting("connect_timeout", 5.0), self.setting("api_timeout", 15.0))
+        self.cdn_timeout = (self.setting("connect_timeout", 5.0), self.setting("cdn_timeout", 15.0))
+        return session
+
     @staticmethod
     def log(x):
         print('{} <SiriusXM>: {}'.format(datetime.datetime.now().strftime('%d.%b %Y %H:%M:%S'), x))
 
+    def setting(self, name, fallback):
+        # values from the [settings] section of config.ini, typed after the fallback
+        if self.settings is None or name not in self.settings:
+            return fallback
+        value = self.settings[name]
+        if isinstance(fallback, bool):
+            return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+        return type(fallback)(value)
+
 
     #TODO: Figure out if authentication is a valid method anymore. It might need a new login each time.
     def is_logged_in(self):
@@ -42,34 +1090,76 @@ class SiriusXM:
     def is_session_authenticated(self):
         return 'Authorization' in self.session.headers
     
-    def sfetch(self, url,retries=0): # if this errors again, its likely VLC or something holding old urls prob, gotta force a refresh then somehow
-        if retries >= 2:
-            self.log("Failed to reauthenticate after 401. Dump: ",self.session.headers)
-        res = self.session.get(url)
+    @staticmethod
+    def method_label(method):
+        # keep metric labels bounded, key and page UUIDs become {id}
+        return re.sub(r'[0-9a-fA-F-]{16,}', '{id}', method)
+
+    @staticmethod
+    def url_label(url):
+        path = url.split('?')[0]
+        if path.endswith('.aac'):
+            return 'segment'
+        if path.endswith('.m3u8'):
+            return 'playlist'
+        return 'other'
+
+    def cache_metrics(self):
+        for name, cache in (("segment", self.segment_cache), ("key", self.key_cache)):
+            stats = cache.stats()
+            labels = {"cache": name}
+            yield 'sxm_cache_hits_total', 'counter', labels, stats["hits"]
+            yield 'sxm_cache_misses_total', 'counter', labels, stats["misses"]
+            yield 'sxm_cache_evictions_total', 'counter', labels, stats["evictions"]
+            yield 'sxm_cache_bytes', 'gauge', labels, stats["bytes"]
+            lookups = stats["hits"] + stats["misses"]
+            yield 'sxm_cache_hit_ratio', 'gauge', labels, stats["hits"] / lookups if lookups else 0
+
+    def sfetch(self, url,retries=0):
+        res = self.sopen(url, retries=retries)
+        if res is None:
+            return None
+        return res.content
+
+    def sopen(self, url, stream=False, retries=0):
+        # a tune shared by another worker can get here before this process has any token
+        if not self.auth.ensure():
+            self.log('Unable to authenticate')
+            return None
+        generation = self.auth.generation
+        try:
+            with self.metrics.timer('sxm_upstream_request_seconds', method='sfetch', endpoint=self.url_label(url)):
+                res = self.session.get(url, stream=stream, timeout=self.cdn_timeout, verify=self.verify)
+        except requests.RequestException as e:
+            self.log("Failed to recieve stream data: {}".format(e))
+            return None
         if res.status_code != 200:
-            if res.status_code >= 400 and res.status_code < 500:
-                self.login()
-                self.authenticate()
-                return self.sfetch(self,url,retries=retries+1)
+            res.close()
+            # an expired token, wait for the shared re-login and replay
+            if res.status_code in self.AUTH_FAILURES and retries < 2 and self.auth.refresh(generation):
+                return self.sopen(url, stream=stream, retries=retries+1)
             self.log("Failed to recieve stream data. Error code {}".format(str(res.status_code)))
             return None
-                
-        return res.content
+        return res
 
     def get(self, method, params={}, authenticate=True, retries=0):
         if retries >= 3:
             self.log("Max retries hit on {} using method Get".format(method))
             return None
-        if authenticate and not self.is_session_authenticated() and not self.authenticate():
+        if authenticate and not self.auth.ensure():
             self.log('Unable to authenticate')
             return None
 
-        res = self.session.get(self.REST_FORMAT.format(method), params=params)
+        generation = self.auth.generation
+        try:
+            with self.metrics.timer('sxm_upstream_request_seconds', method='get', endpoint=self.method_label(method)):
+                res = self.session.get(self.REST_FORMAT.format(method), params=params, timeout=self.api_timeout, verify=self.verify)
+        except requests.RequestException as e:
+            self.log('Request for method \'{}\' failed: {}'.format(method, e))
+            return None
         if res.status_code != 200:
-            if res.status_code >= 400 and res.status_code < 500:
-                self.login()
-                self.authenticate()
-                return self.post(method, postdata=params, authenticate=authenticate, retries=retries+1)
+            if res.status_code in self.AUTH_FAILURES and authenticate and self.auth.refresh(generation):
+                return self.get(method, params=params, authenticate=authenticate, retries=retries+1)
             self.log('Received status code {} for method \'{}\''.format(res.status_code, method))
             return None
 
@@ -79,35 +1169,51 @@ class SiriusXM:
             self.log('Error decoding json for method \'{}\''.format(method))
             return None
 
-    def post(self, method, postdata, authenticate=True, headers={},retries=0):
+    def post(self, method, postdata, authenticate=True, headers={},retries=0, session=None):
+        # `session` is a login in progress (see new_session), the live one by default
+        session = session or self.session
         if retries >= 3:
             self.log("Max retries hit on {} using method Post".format(method))
             return None
-        if authenticate and not self.is_session_authenticated() and not self.authenticate():
+        if authenticate and not self.auth.ensure():
             self.log('Unable to authenticate')
             return None
 
-        res = self.session.post(self.REST_FORMAT.format(method), data=json.dumps(postdata),headers=headers)
+        generation = self.auth.generation
+        try:
+            with self.metrics.timer('sxm_upstream_request_seconds', method='post', endpoint=self.method_label(method)):
+                res = session.post(self.REST_FORMAT.format(method), data=json.dumps(postdata),headers=headers, timeout=self.api_timeout, verify=self.verify)
+        except requests.RequestException as e:
+            self.log('Request for method \'{}\' failed: {}'.format(method, e))
+            return None
         if res.status_code != 200 and res.status_code != 201:
-            if res.status_code >= 400 and res.status_code < 500:
-                self.login()
-                self.authenticate()
+            # handshake calls (authenticate=False) are part of a refresh, don't recurse into another one
+            if res.status_code in self.AUTH_FAILURES and authenticate and self.auth.refresh(generation):
                 return self.post(method,postdata,authenticate,headers,retries+1)
             self.log('Received status code {} for method \'{}\''.format(res.status_code, method))
             return None
 
-        resjson = res.json()
-        bearer_token = resjson["grant"] if "grant" in resjson else resjson["accessToken"] if "accessToken" in resjson else None
-        if bearer_token != None:
-            self.session.headers.update({"Authorization": f"Bearer {bearer_token}"})
-
         try:
-            return resjson
+            resjson = res.json()
         except ValueError:
             self.log('Error decoding json for method \'{}\''.format(method))
             return None
+        bearer_token = resjson["grant"] if "grant" in resjson else resjson["accessToken"] if "accessToken" in resjson else None
+        if bearer_token != None:
+            session.headers.update({"Authorization": f"Bearer {bearer_token}"})
 
-    def login(self):
+        return resjson
+
+    def new_session(self):
+        # a session to log in on beside the live one; it shares the connection
+        # pools, and the live token keeps serving until the new one replaces it
+        session = requests.Session()
+        session.headers.update({'User-Agent': self.USER_AGENT})
+        for prefix, adapter in self.session.adapters.items():
+            session.mount(prefix, adapter)
+        return session
+
+    def login(self, session):
         # Four layer process
         # Assuming the login can work separate from Auth, this is split into two connections:
         # 1) device acknowledge
@@ -116,10 +1222,6 @@ class SiriusXM:
         # Login
         # Affirm Authentication
 
-        # do a completely new session
-        self.session = requests.Session()
-        self.session.headers.update({'User-Agent': self.USER_AGENT})
-
         postdata = {
             'devicePlatform': "web-desktop",
             'deviceAttributes': {
@@ -137,26 +1239,26 @@ class SiriusXM:
         sxmheaders = {
             "x-sxm-tenant":"sxm" # required, but not used everywhere
         }
-        data = self.post('device/v1/devices', postdata, authenticate=False,headers=sxmheaders)
+        data = self.post('device/v1/devices', postdata, authenticate=False,headers=sxmheaders,session=session)
         if not data:
-            self.log("Error creating device session:",data)
+            self.log("Error creating device session: {}".format(data))
             return False
 
         # Once device is registered, grant anonymous permissions 
-        data = self.post('session/v1/sessions/anonymous', {}, authenticate=False,headers=sxmheaders)
+        data = self.post('session/v1/sessions/anonymous', {}, authenticate=False,headers=sxmheaders,session=session)
         if not data:
-            self.log("Error validating anonymous session:",data)
+            self.log("Error validating anonymous session: {}".format(data))
             return False
         try:
-            return "accessToken" in data and self.is_logged_in()
+            return "accessToken" in data and 'Authorization' in session.headers
         except KeyError:
             self.log('Error decoding json response for login')
             return False
         
 
 
-    def authenticate(self):
-        if not self.is_logged_in() and not self.login():
+    def authenticate(self, session):
+        if 'Authorization' not in session.headers and not self.login(session):
             self.log('Unable to authenticate because login failed')
             return False
 
@@ -164,16 +1266,16 @@ class SiriusXM:
             "handle": self.username,
             "password": self.password
         }
-        data = self.post('identity/v1/identities/authenticate/password', postdata, authenticate=False)
+        data = self.post('identity/v1/identities/authenticate/password', postdata, authenticate=False, session=session)
         if not data:
             return False
 
         
-        autheddata = self.post('session/v1/sessions/authenticated', {}, authenticate=False)
+        autheddata = self.post('session/v1/sessions/authenticated', {}, authenticate=False, session=session)
 
         try:
-            return autheddata['sessionType'] == "authenticated" and self.is_session_authenticated()
-        except KeyError:
+            return autheddata['sessionType'] == "authenticated" and 'Authorization' in session.headers
+        except (KeyError, TypeError):
             self.log('Error parsing json response for authentication')
             return False
 
@@ -183,170 +1285,299 @@ class SiriusXM:
         # Create our own M3U8 from scratch, include all we found
         if not self.channels:
             self.get_channels()
-        if not self.m3u8dat:
-            data = []
-            data.append("#EXTM3U")
-            m3umetadata = """#EXTINF:-1 tvg-id="{}" tvg-logo="{}" group-title="{}",{}\n{}"""
-            for channel in self.channels:
-                #TODO: Work on finding the proper M3U8 metadata needed.
-                title = channel["title"]
-                genre = channel["genre"]
-                logo = channel["logo"]
-                channel_id = channel["channel_id"]
-                url = "/listen/{}".format(channel["id"])
-                formattedm3udata = m3umetadata.format(channel_id,logo,genre,title,url)
-                data.append(formattedm3udata)
-            self.m3u8dat = "\n".join(data)
+        channels = self.channels
+        if not self.m3u8dat and channels:
+            m3u8dat = EncodedBody(self.render_m3u(channels))
+            # don't publish a playlist of a list that was swapped out meanwhile
+            with self.catalog_lock:
+                if channels is self.channels:
+                    self.m3u8dat = m3u8dat
+            return m3u8dat
         
         return self.m3u8dat
 
+    @staticmethod
+    def render_m3u(channels):
+        data = []
+        data.append("#EXTM3U")
+        for channel in channels:
+            data.append(channel.m3u)
+        return "\n".join(data).encode('utf-8')
+
+    @staticmethod
+    def render_epg_json(channels):
+        return json.dumps({"channels": [dict(channel.to_dict(), url=channel.url) for channel in channels]}).encode('utf-8')
+
+    @staticmethod
+    def render_xmltv(channels):
+        # channel list only, the browse data carries no programme schedule
+        data = ['<?xml version="1.0" encoding="UTF-8"?>', '<tv generator-info-name="m3u8XM">']
+        for channel in channels:
+            data.append('  <channel id={}>'.format(quoteattr(str(channel.channel_id))))
+            data.append('    <display-name>{}</display-name>'.format(escape(channel.title)))
+            data.append('    <icon src={}/>'.format(quoteattr(channel.logo)))
+            data.append('  </channel>')
+        data.append('</tv>')
+        return "\n".join(data).encode('utf-8')
+
+    def get_filtered(self, fmt, params):
+        # playlist or EPG of a subset of the catalog, e.g. ?genre=Rock&type=linear&channels=1-99&ids=<id>,<id>
+        if not self.channels:
+            self.get_channels()
+        catalog = self.channels
+        if not catalog:
+            return None
+        def values(name):
+            return [v.strip() for value in params.get(name, []) for v in value.split(',') if v.strip()]
+        ranges = []
+        for value in values("channels"):
+            low, _, high = value.partition('-')
+            try:
+                ranges.append((int(low), int(high or low)))
+            except ValueError:
+                pass
+        filters = (tuple(values("genre")), tuple(values("type")), tuple(ranges), tuple(values("ids")))
+        key = (fmt,) + filters
+        body = catalog.views.get(key)
+        if body is None:
+            channels = catalog.select(*filters)
+            render = {"m3u": self.render_m3u, "json": self.render_epg_json, "xmltv": self.render_xmltv}[fmt]
+            body = EncodedBody(render(channels))
+            if len(catalog.views) >= 256:
+                catalog.views.clear()
+            catalog.views[key] = body
+        return body
+
     def get_channels(self):
-        # download channel list if necessary
-        # todo: find out if the container ID or the UUID changes; how to auto fetch if so.
-        # channel list is split up. gotta get every channel
+        # download channel list if necessary, only one thread does the sweep
+        if not self.channels:
+            with self.catalog_lock:
+                if not self.channels:
+                    # another worker may have swept it already
+                    self.channels = self.load_shared_catalog() or self.fetch_channels()
+                    self.save_catalog()
+        return self.channels
+
+    def load_shared_catalog(self):
+        data = self.state.get("catalog", "channels")
+        if not data:
+            return None
+        return ChannelCatalog([Channel.from_dict(channel) for channel in data["channels"]])
 
+    def load_catalog(self):
+        # start from the channel list of the last run so the first playlist is instant
+        if not self.catalog_cache or not os.path.exists(self.catalog_cache):
+            return False
+        try:
+            with open(self.catalog_cache, 'r', encoding='utf-8') as f:
+                channels = json.load(f)["channels"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log("Ignoring unreadable channel cache {}: {}".format(self.catalog_cache, e))
+            return False
+        if channels:
+            self.channels = ChannelCatalog([Channel.from_dict(channel) for channel in channels])
+            self.log("Loaded {} channels from {}".format(len(channels), self.catalog_cache))
+        return bool(channels)
+
+    def save_catalog(self):
         if not self.channels:
-            self.channels = []
-            # todo: this is how the web traffic processed the channels, might not be needed though
-            initData = {
-                "containerConfiguration": {
-                    "3JoBfOCIwo6FmTpzM1S2H7": {
-                        "filter": {
-                            "one": {
-                                "filterId": "all"
-                            }
-                        },
-                        "sets": {
-                            "5mqCLZ21qAwnufKT8puUiM": {
-                                "sort": {
-                                    "sortId": "CHANNEL_NUMBER_ASC"
-                                }
-                            }
-                        }
-                    }
-                },
-                "pagination": {
-                    "offset": {
-                        "containerLimit": 3,
-                        "setItemsLimit": 50
-                    }
-                },
-                "deviceCapabilities": {
-                    "supportsDownloads": False
-                }
-            }
-            data = self.post('browse/v1/pages/curated-grouping/403ab6a5-d3c9-4c2a-a722-a94a6a5fd056/view', initData)
-            if not data:
-                self.log('Unable to get init channel list')
-                return (None, None)
-            for channel in data["page"]["containers"][0]["sets"][0]["items"]:
-                title = channel["entity"]["texts"]["title"]["default"]
-                description = channel["entity"]["texts"]["description"]["default"]
-                genre = channel["decorations"]["genre"] if "genre" in channel["decorations"] else ""
-                channel_id = channel["decorations"]["channelNumber"]
-                channel_type = channel["actions"]["play"][0]["entity"]["type"]
-                logo = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["url"]
-                logo_width = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["width"]
-                logo_height = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["height"]
-                id = channel["entity"]["id"]
-                jsonlogo = json.dumps({
-                    "key": logo,
-                    "edits":[
-                        {"format":{"type":"jpeg"}},
-                        {"resize":{"width":logo_width,"height":logo_height}}
-                    ]
-                },separators=(',', ':'))
-                b64logo = base64.b64encode(jsonlogo.encode("ascii")).decode("utf-8")
-                self.channels.append({
-                    "title": title,
-                    "description": description,
-                    "genre": genre,
-                    "channel_id": channel_id,
-                    "channel_type": channel_type,
-                    "logo":  self.CDN_URL.format(b64logo),
-                    "url": "/listen/{}".format(id),
-                    "id": id
-                })
-                
-            channellen = data["page"]["containers"][0]["sets"][0]["pagination"]["offset"]["size"]
-            for offset in range(50,channellen,50):
-                postdata = {
+            return
+        data = {"updated": time.time(), "channels": [channel.to_dict() for channel in self.channels]}
+        self.state.put("catalog", "channels", data)
+        if not self.catalog_cache:
+            return
+        # write next to the cache and rename, so a crash never leaves half a file;
+        # the pid keeps pre-forked workers saving at the same time apart
+        tmp = "{}.{}.tmp".format(self.catalog_cache, os.getpid())
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.catalog_cache)
+        except OSError as e:
+            self.log("Unable to write channel cache {}: {}".format(self.catalog_cache, e))
+
+    def refresh_catalog(self):
+        channels = self.fetch_channels()
+        if not channels:
+            self.log("Channel list refresh failed, keeping the current list")
+            return False
+        with self.catalog_lock:
+            self.channels = channels
+            self.m3u8dat = None
+        self.save_catalog()
+        return True
+
+    def refresh_catalog_loop(self):
+        if self.catalog_refresh <= 0:
+            return
+        delay = self.catalog_refresh
+        if self.catalog_cache and os.path.exists(self.catalog_cache):
+            # a stale cache from a long stopped run gets refreshed right away
+            delay = max(0, self.catalog_refresh - (time.time() - os.path.getmtime(self.catalog_cache)))
+        while True:
+            time.sleep(delay)
+            delay = self.catalog_refresh
+            if not self.channels:
+                continue
+            try:
+                shared = self.state.get("catalog", "channels")
+                if shared and time.time() - shared["updated"] < self.catalog_refresh / 2:
+                    # another worker refreshed it recently, take theirs
+                    with self.catalog_lock:
+                        self.channels = ChannelCatalog([Channel.from_dict(channel) for channel in shared["channels"]])
+                        self.m3u8dat = None
+                else:
+                    self.refresh_catalog()
+            except Exception as e:
+                # keep the current list and the loop, try again next round
+                self.log("Channel list refresh failed: {}".format(e))
+
+    def fetch_channels(self):
+        # todo: find out if the container ID or the UUID changes; how to auto fetch if so.
+        # channel list is split up. gotta get every channel
+        # the list is built locally so other threads never see it half filled
+        channels = []
+        # todo: this is how the web traffic processed the channels, might not be needed though
+        initData = {
+            "containerConfiguration": {
+                "3JoBfOCIwo6FmTpzM1S2H7": {
                     "filter": {
                         "one": {
-                        "filterId": "all"
+                            "filterId": "all"
                         }
                     },
                     "sets": {
                         "5mqCLZ21qAwnufKT8puUiM": {
-                        "sort": {
-                            "sortId": "CHANNEL_NUMBER_ASC"
-                        },
-                        "pagination": {
-                            "offset": {
-                            "setItemsOffset": offset,
-                            "setItemsLimit": 50
+                            "sort": {
+                                "sortId": "CHANNEL_NUMBER_ASC"
                             }
                         }
-                        }
-                    },
-                    "pagination": {
-                        "offset": {
-                        "setItemsLimit": 50
-                        }
                     }
                 }
-                data = self.post('browse/v1/pages/curated-grouping/403ab6a5-d3c9-4c2a-a722-a94a6a5fd056/containers/3JoBfOCIwo6FmTpzM1S2H7/view', postdata, initData)
-                if not data:
-                    self.log('Unable to get fetch channel list chunk')
-                    return (None, None)
-                for channel in data["container"]["sets"][0]["items"]:
-                    title = channel["entity"]["texts"]["title"]["default"]
-                    description = channel["entity"]["texts"]["description"]["default"]
-                    genre = channel["decorations"]["genre"] if "genre" in channel["decorations"] else ""
-                    channel_id = channel["decorations"]["channelNumber"]
-                    channel_type = channel["actions"]["play"][0]["entity"]["type"]
-                    logo = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["url"]
-                    logo_width = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["width"]
-                    logo_height = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["height"]
-                    id = channel["entity"]["id"]
-                    jsonlogo = json.dumps({
-                        "key": logo,
-                        "edits":[
-                            {"format":{"type":"jpeg"}},
-                            {"resize":{"width":logo_width,"height":logo_height}}
-                        ]
-                    },separators=(',', ':'))
-                    b64logo = base64.b64encode(jsonlogo.encode("ascii")).decode("utf-8")
-                    self.channels.append({
-                        "title": title,
-                        "description": description,
-                        "genre": genre,
-                        "channel_id": channel_id,
-                        "channel_type": channel_type,
-                        "logo":  self.CDN_URL.format(b64logo),
-                        "url": "/listen/{}".format(id),
-                        "id": id
-                    })
+            },
+            "pagination": {
+                "offset": {
+                    "containerLimit": 3,
+                    "setItemsLimit": 50
+                }
+            },
+            "deviceCapabilities": {
+                "supportsDownloads": False
+            }
+        }
+        data = self.post('browse/v1/pages/curated-grouping/403ab6a5-d3c9-4c2a-a722-a94a6a5fd056/view', initData)
+        if not data:
+            self.log('Unable to get init channel list')
+            return None
+        try:
+            channels.extend(self.parse_channel_item(channel) for channel in data["page"]["containers"][0]["sets"][0]["items"])
+            # the first page tells us how many there are, fetch the rest side by side
+            channellen = data["page"]["containers"][0]["sets"][0]["pagination"]["offset"]["size"]
+        except (KeyError, IndexError):
+            self.log('Error parsing the first channel list page')
+            return None
+        offsets = list(range(50,channellen,50))
+        if offsets:
+            with ThreadPoolExecutor(max_workers=self.setting("catalog_workers", 4)) as pool:
+                pages = list(pool.map(self.fetch_channel_page, offsets))
+            # a half filled channel list is worse than the one we already have
+            if None in pages:
+                self.log('Unable to get fetch channel list chunk')
+                return None
+            for page in pages:
+                channels.extend(page)
 
-        return self.channels
+        return ChannelCatalog(channels)
+
+    def fetch_channel_page(self, offset):
+        postdata = {
+            "filter": {
+                "one": {
+                "filterId": "all"
+                }
+            },
+            "sets": {
+                "5mqCLZ21qAwnufKT8puUiM": {
+                "sort": {
+                    "sortId": "CHANNEL_NUMBER_ASC"
+                },
+                "pagination": {
+                    "offset": {
+                    "setItemsOffset": offset,
+                    "setItemsLimit": 50
+                    }
+                }
+                }
+            },
+            "pagination": {
+                "offset": {
+                "setItemsLimit": 50
+                }
+            }
+        }
+        data = self.post('browse/v1/pages/curated-grouping/403ab6a5-d3c9-4c2a-a722-a94a6a5fd056/containers/3JoBfOCIwo6FmTpzM1S2H7/view', postdata)
+        if not data:
+            return None
+        try:
+            return [self.parse_channel_item(channel) for channel in data["container"]["sets"][0]["items"]]
+        except (KeyError, IndexError):
+            self.log('Error parsing channel list chunk at offset {}'.format(offset))
+            return None
+
+    def parse_channel_item(self, channel):
+        title = channel["entity"]["texts"]["title"]["default"]
+        description = channel["entity"]["texts"]["description"]["default"]
+        genre = channel["decorations"]["genre"] if "genre" in channel["decorations"] else ""
+        channel_id = channel["decorations"]["channelNumber"]
+        channel_type = channel["actions"]["play"][0]["entity"]["type"]
+        logo = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["url"]
+        logo_width = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["width"]
+        logo_height = channel["entity"]["images"]["tile"]["aspect_1x1"]["preferred"]["height"]
+        id = channel["entity"]["id"]
+        jsonlogo = json.dumps({
+            "key": logo,
+            "edits":[
+                {"format":{"type":"jpeg"}},
+                {"resize":{"width":logo_width,"height":logo_height}}
+            ]
+        },separators=(',', ':'))
+        b64logo = base64.b64encode(jsonlogo.encode("ascii")).decode("utf-8")
+        return Channel(id, title, description, genre, channel_id, channel_type, self.CDN_URL.format(b64logo))
 
-    #temporary patch, should do a reverse index lookup table
     def get_channel_info(self,id):
         if not self.channels:
             self.get_channels()
-        for ch in self.channels:
-            if id == ch["id"]:
-                return ch
-        return None
+        if not self.channels:
+            return None
+        return self.channels.by_id.get(id)
+
+    def resolve_channel(self, id):
+        # urls may name a channel by its number (/listen/101), everything else keys on the id
+        channel = self.get_channel_info(id)
+        if channel is None and self.channels:
+            channel = self.channels.by_number.get(id)
+        return channel.id if channel else id
 
-    def get_tuner(self,id):
+    def get_tuner(self,id,force=False):
+        # ids come straight from client urls: only catalog channels get tuned, or a lock
+        if self.get_channel_info(id) is None:
+            self.log("Unknown channel {}".format(id))
+            return None
+        # serialise tunes per channel so concurrent listeners share one tuneSource call
+        with self.tune_locks.setdefault(id, threading.Lock()):
+            return self.tune(id,force)
+
+    def tune(self,id,force=False):
         channel_info = self.get_channel_info(id)
-        channel_type = channel_info["channel_type"] if channel_info and "channel_type" in channel_info else "channel-linear"
+        channel_type = channel_info.channel_type if channel_info else "channel-linear"
         isXtra = channel_type == "channel-xtra"
-        if id in self.stream_urls and isXtra == False:
-            return self.stream_urls[id]
-        #if contextId != None and contextId in self.xtra_streams and isXtra == True:
-        #    return self.xtra_streams[contextId]
+        previous = self.stream_urls.get(id)
+        if previous is None:
+            previous = self.state.get("tuner", id)
+            if previous:
+                self.stream_urls.put(id, previous)
+        if previous and isXtra == False and not force:
+            return previous
         postdata = {
             "id":id,
             "type":channel_type,
@@ -356,9 +1587,9 @@ class SiriusXM:
 
         hasContextId = False
         contextId = ''
-        if isXtra and id in self.stream_urls and "sourceContextId" in self.stream_urls[id]:
+        if isXtra and previous and previous.get("sourceContextId"):
             hasContextId = True
-            contextId = self.stream_urls[id]["sourceContextId"]
+            contextId = previous["sourceContextId"]
         if hasContextId:
             postdata["sourceContextId"] = contextId
         else:
@@ -378,7 +1609,6 @@ class SiriusXM:
             sessionId = str(random.randint((10**37),(10**38)))
             sourceContextId = data["streams"][0]["metadata"]["xtra"]["sourceContextId"] 
             streaminfo["sessionId"] = sessionId
-            streaminfo["expires"] = time.time()+600 # expire/remove this stream in 10 minutes
         base_url, m3u8_loc = primarystreamurl.rsplit('/', 1)
         streaminfo["base_url"] = base_url
         streaminfo["sources"] = m3u8_loc
@@ -389,107 +1619,599 @@ class SiriusXM:
             self.log("Failed to fetch m3u8 stream details")
             return False
         streamdata = streamdata.decode("utf-8")
-        # TODO: make this have options for other qualities (url parameter?)
+        # keep every rendition of the master playlist, keyed by its directory (e.g. 64k)
+        variants = {}
+        inf = None
         for line in streamdata.splitlines():
-            if line.find("256k") > 0 and line.endswith("m3u8"):
-                streaminfo["quality"] = line
-                streaminfo["HLS"] = line.split("/")[0]
+            if line.startswith("#EXT-X-STREAM-INF"):
+                inf = line
+            elif line.endswith("m3u8"):
+                name = line.split("/")[0] if "/" in line else line.rsplit(".", 1)[0]
+                bandwidth = re.search(r'[:,]BANDWIDTH=(\d+)', inf or '')
+                variants[name] = {
+                    "quality": line,
+                    "HLS": line.split("/")[0],
+                    "inf": inf or "#EXT-X-STREAM-INF:BANDWIDTH=0",
+                    "bandwidth": int(bandwidth.group(1)) if bandwidth else 0
+                }
+                inf = None
+        if not variants:
+            self.log("No variants in m3u8 stream details")
+            return False
+        streaminfo["variants"] = variants
+        default = self.rendition(streaminfo, self.default_quality)
+        streaminfo["quality"] = default["quality"]
+        streaminfo["HLS"] = default["HLS"]
         if isXtra:
-            self.xtra_streams[ sessionId ] = streaminfo
-        self.stream_urls[id] = streaminfo
+            self.xtra_streams.put(sessionId, streaminfo)
+            self.state.put("xtra", sessionId, streaminfo, self.xtra_streams.ttl)
+        self.stream_urls.put(id, streaminfo)
+        self.state.put("tuner", id, streaminfo, self.stream_urls.ttl)
         return streaminfo
-    
-    def get_tuner_cached(self,id,sessionId):
-            return self.xtra_streams[sessionId]
-    
-    def cleanup_streaminfo(self,delay=600):
+
+    def maintain_tuners(self,delay=30):
         while True:
-            now = time.time()
-            keys_to_delete = [sessionId for sessionId in self.xtra_streams.keys() if self.xtra_streams[sessionId]["expires"] < now]
-            for k in keys_to_delete:
-                del self.xtra_streams[k]
             time.sleep(delay)
+            self.stream_urls.cleanup()
+            self.xtra_streams.cleanup()
+            # re-tune linear channels in use before their stream url goes stale
+            for id in self.stream_urls.expiring(self.tuner_refresh_ahead):
+                streaminfo = self.stream_urls.get(id)
+                if streaminfo and not streaminfo.get("sessionId"):
+                    try:
+                        self.get_tuner(id, force=True)
+                    except Exception as e:
+                        self.log("Refreshing tuner of {} failed: {}".format(id, e))
     
-    def get_channel(self, id):
+    def rendition(self, streaminfo, quality=None):
+        # stream info narrowed to one variant; unknown qualities fall back to the
+        # configured default, then to the highest bandwidth on offer
+        variants = streaminfo.get("variants") or {}
+        variant = variants.get(quality) or variants.get(self.default_quality)
+        if variant is None:
+            for name, v in variants.items():
+                if self.default_quality in name:
+                    variant = v
+                    break
+        if variant is None:
+            variant = max(variants.values(), key=lambda v: v["bandwidth"])
+        return dict(streaminfo, quality=variant["quality"], HLS=variant["HLS"])
+
+    def get_master_playlist(self, id):
+        # every upstream rendition with its BANDWIDTH, so players can switch adaptively;
+        # Xtra sessions are carried along so all renditions share the one tune
+        streaminfo = self.get_tuner(id)
+        if not streaminfo:
+            return False
+        sessionId = streaminfo.get("sessionId") or ''
+        session = "&session={}".format(sessionId) if sessionId else ''
+        lines = ["#EXTM3U"]
+        for name, variant in sorted(streaminfo["variants"].items(), key=lambda x: x[1]["bandwidth"]):
+            lines.append(variant["inf"])
+            lines.append("{}?quality={}{}".format(id, urllib.parse.quote(name), session))
+        return '\n'.join(lines).encode('utf-8')
+
+    def get_channel(self, id, quality=None, sessionId=''):
         # Hit a wall in how I wanted to implement this, but this is what I ended up doing:
         # Caching the /tuneSource url provided, and associating it to the /listen UUID
         # this prevents multiple hits to /tuneSource and more to the Streaming CDN
         # potentially speeding this part of the process up, as well as being more subtle
         # in main site web traffic.
-        streaminfo = self.get_tuner(id)
-        sessionId = streaminfo["sessionId"] if "sessionId" in streaminfo and streaminfo["sessionId"] != None else ''
-        aacurl = "{}/{}".format(streaminfo["base_url"],streaminfo["quality"])
-        # fetch the list of aac files
-        data = self.sfetch(aacurl)
+        streaminfo = self.get_streaminfo(id, sessionId)
+        if not streaminfo:
+            return False
+        sessionId = streaminfo["sessionId"] if "sessionId" in streaminfo and streaminfo["sessionId"] != None else sessionId
+        # the rewritten list of aac files is kept fresh by a single poller per stream
+        data = self.poller.get(id, self.rendition(streaminfo, quality), sessionId)
         if not data:
             self.log("failed to fetch AAC stream list")
             return False
-        data = data.decode("utf-8")
-        data = data.replace("https://api.edge-gateway.siriusxm.com/playback/key/v1/","/key/",1)
-        lineoutput = []
-        lines = data.splitlines()
-        for x in range(len(lines)):
-            if lines[x].rstrip().endswith('.aac'):
-                lines[x] = '{}/{}?{}'.format(id, lines[x],sessionId)
+        return data
+
+    def rewrite_media_playlist(self, id, data, HLStag):
+        # point the key at our /key/ route and the segments at /listen/<id>/<rendition>/,
+        # cutting the result after every "?" that takes the client's sessionId
+        # (with decrypt_segments the segments are served clear and the key lines go)
+        data = data.replace(self.REST_FORMAT.format("playback/key/v1/"),"/key/",1)
+        pieces = []
+        current = []
+        for line in data.splitlines():
+            if self.decrypt and line.startswith("#EXT-X-KEY:"):
+                continue
+            if line.rstrip().endswith('.aac'):
+                current.append('{}/{}/{}?'.format(id, HLStag, line))
+                pieces.append('\n'.join(current).encode('utf-8'))
+                current = ['']
+            else:
+                current.append(line)
+        pieces.append('\n'.join(current).encode('utf-8'))
+        return pieces
+
+    def timeshift_buffer(self, id, HLStag, targetduration=None):
+        with self.timeshift_lock:
+            buffer = self.timeshift.get((id, HLStag))
+            if buffer is None and targetduration:
+                os.makedirs(self.timeshift_dir, exist_ok=True)
+                slots = int(self.timeshift_minutes * 60 / targetduration) + 1
+                # one ring per process, pre-forked workers each record the streams they serve
+                path = os.path.join(self.timeshift_dir, "{}_{}_{}.ring".format(id, HLStag, os.getpid()))
+                buffer = self.timeshift[(id, HLStag)] = TimeShiftBuffer(path, slots, self.timeshift_slot_size, targetduration)
+            return buffer
+
+    def timeshift_close(self, id, HLStag):
+        with self.timeshift_lock:
+            buffer = self.timeshift.pop((id, HLStag), None)
+            self.timeshift_recorded.pop((id, HLStag), None)
+        if buffer is not None:
+            buffer.close()
+
+    def timeshift_wait(self, id, HLStag, timeout=15):
+        # a stream nobody polled yet gets its ring on the first poll, wait for that
+        with self.timeshift_lock:
+            recorded = self.timeshift_recorded.setdefault((id, HLStag), threading.Event())
+        recorded.wait(timeout)
+        return self.timeshift_buffer(id, HLStag)
+
+    def timeshift_record(self, id, streaminfo, targetduration, entries):
+        # called by the playlist poller, copies segments new to the window into the ring
+        buffer = self.timeshift_buffer(id, streaminfo["HLS"], targetduration)
+        for entry in entries:
+            if entry["name"] in buffer:
+                continue
+            data = self.fetch_segment(streaminfo, entry["name"], entry)
+            if not data:
+                continue
+            # decrypted segments go in clear, without their key line
+            key = None if self.decrypt else entry["key"]
+            if key:
+                key = key.replace(self.REST_FORMAT.format("playback/key/v1/"),"/key/",1)
+                # the ring renumbers segments, so pin the IV HLS would derive from the upstream sequence
+                if "METHOD=AES-128" in key and "IV=" not in key:
+                    key = "{},IV=0x{:032x}".format(key, entry["sequence"])
+            buffer.add(entry["name"], data, entry["duration"], key)
+        with self.timeshift_lock:
+            self.timeshift_recorded.setdefault((id, streaminfo["HLS"]), threading.Event()).set()
+
+    def get_timeshift_playlist(self, id, quality=None):
+        # DVR style playlist over the whole window; asking for it keeps the poller feeding the ring
+        streaminfo = self.get_tuner(id)
+        if not streaminfo:
+            return False
+        streaminfo = self.rendition(streaminfo, quality)
+        self.poller.get(id, streaminfo)
+        buffer = self.timeshift_wait(id, streaminfo["HLS"])
+        if buffer is None:
+            return False
+        entries = buffer.entries()
+        if not entries:
+            return False
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:{}".format(buffer.targetduration), "#EXT-X-MEDIA-SEQUENCE:{}".format(entries[0][0])]
+        key = None
+        for seq, (slot, length, name, duration, segkey) in entries:
+            if segkey and segkey != key:
+                lines.append(segkey)
+                key = segkey
+            lines.append("#EXTINF:{:.3f},".format(duration))
+            lines.append("{}/{}/{}.aac".format(id, streaminfo["HLS"], seq))
         return '\n'.join(lines).encode('utf-8')
 
-    def get_segment(self,id,seg,sessionId=''):
-        streaminfo = None
-        if sessionId != '':
-            streaminfo = self.get_tuner_cached(id,sessionId)      
-        else:      
+    def get_timeshift_segment(self, id, HLStag, seq):
+        buffer = self.timeshift_buffer(id, HLStag)
+        if buffer is None:
+            return None
+        return buffer.read(seq)
+
+    def record(self, id, quality=None):
+        # copy the current window to recordings/<id>_<time>/ as a VOD playlist with its segments
+        streaminfo = self.get_tuner(id)
+        if not streaminfo:
+            return None
+        HLStag = self.rendition(streaminfo, quality)["HLS"]
+        buffer = self.timeshift_buffer(id, HLStag)
+        if buffer is None:
+            return None
+        path = os.path.join(self.recordings_dir, "{}_{}".format(id, time.strftime('%Y%m%d-%H%M%S')))
+        os.makedirs(path, exist_ok=True)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:{}".format(buffer.targetduration), "#EXT-X-PLAYLIST-TYPE:VOD"]
+        key = None
+        count = 0
+        for seq, (slot, length, name, duration, segkey) in buffer.entries():
+            data = buffer.read(seq)
+            if data is None:
+                continue
+            with open(os.path.join(path, "{}.aac".format(seq)), 'wb') as f:
+                f.write(data)
+            if segkey and segkey != key:
+                lines.append(segkey)
+                key = segkey
+            lines.append("#EXTINF:{:.3f},".format(duration))
+            lines.append("{}.aac".format(seq))
+            count += 1
+        lines.append("#EXT-X-ENDLIST")
+        with open(os.path.join(path, "index.m3u8"), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return {"path": path, "segments": count}
+
+    def fetch_media_playlist(self, streaminfo):
+        aacurl = "{}/{}".format(streaminfo["base_url"],streaminfo["quality"])
+        data = self.sfetch(aacurl)
+        if not data:
+            return None
+        return data.decode("utf-8")
+
+    def get_streaminfo(self, id, sessionId=''):
+        if sessionId == '':
+            return self.get_tuner(id)
+        # a valid Xtra session doesn't vouch for the id next to it, which keys the
+        # poller and the per-channel metrics
+        if self.get_channel_info(id) is None:
+            self.log("Unknown channel {}".format(id))
+            return None
+        streaminfo = self.xtra_streams.get(sessionId)
+        if streaminfo is None:
+            # the session may have been tuned by another worker
+            streaminfo = self.state.get("xtra", sessionId)
+            if streaminfo:
+                self.xtra_streams.put(sessionId, streaminfo)
+        if streaminfo is None:
+            # the session expired under the client, tune again and keep its sessionId working
+            self.log("Xtra session of {} expired, retuning".format(id))
             streaminfo = self.get_tuner(id)
+            if streaminfo:
+                self.xtra_streams.put(sessionId, streaminfo)
+                self.state.put("xtra", sessionId, streaminfo, self.xtra_streams.ttl)
+        return streaminfo
+
+    def get_segment(self,id,seg,sessionId='',quality=None):
+        streaminfo = self.get_streaminfo(id, sessionId)
+        if not streaminfo:
+            return None
+        streaminfo = self.rendition(streaminfo, quality)
+        if self.decrypt:
+            return self.fetch_segment(streaminfo, seg, self.poller.entry(id, streaminfo, seg))
+        self.poller.touch(id, streaminfo)
+        return self.fetch_segment(streaminfo, seg)
+
+    def fetch_segment(self, streaminfo, seg, entry=None, clear=False):
+        # `entry` is the segment's parsed playlist entry, needed to decrypt it;
+        # segments come back decrypted with decrypt_segments or when `clear` asks for it
         baseurl = streaminfo["base_url"]
         HLStag = streaminfo["HLS"]
         segmenturl = "{}/{}/{}".format(baseurl,HLStag,seg)
-        data = self.sfetch(segmenturl)
-        return data
+        if self.decrypt or clear:
+            fetch = lambda: self.sfetch(segmenturl)
+            if not self.decrypt:
+                # HLS listeners get these encrypted, share the download with them
+                fetch = lambda: self.segment_cache.get_or_fetch((baseurl,HLStag,seg), lambda: self.sfetch(segmenturl))
+            # the clear bytes are cached too, so each segment is decrypted once for all listeners
+            return self.segment_cache.get_or_fetch((baseurl,HLStag,seg,"clear"), lambda: self.decrypt_segment(fetch(), entry))
+        # every listener of a channel asks for the same segments, only hit the CDN once
+        return self.segment_cache.get_or_fetch((baseurl,HLStag,seg), lambda: self.sfetch(segmenturl))
+
+    def decrypt_segment(self, data, entry):
+        # AES-128-CBC as HLS does it: the key from the EXT-X-KEY URI, the IV from
+        # its IV attribute or else the media sequence number, PKCS7 padding
+        if not data:
+            return None
+        if entry is None:
+            self.log("No playlist entry for segment, unable to decrypt it")
+            return None
+        attributes = dict(re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', entry["key"] or ''))
+        method = attributes.get("METHOD", "NONE")
+        if method == "NONE":
+            return data
+        if method != "AES-128":
+            self.log("Unsupported segment encryption {}".format(method))
+            return None
+        key = self.getAESkey(attributes.get("URI", '').strip('"').split('/')[-1])
+        if not key:
+            return None
+        iv = attributes.get("IV")
+        iv = bytes.fromhex(iv[2:].rjust(32, '0')) if iv else entry["sequence"].to_bytes(16, 'big')
+        start = time.thread_time()
+        try:
+            decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+            clear = decryptor.update(data) + decryptor.finalize()
+        except ValueError as e:
+            self.log("Unable to decrypt {}: {}".format(entry["name"], e))
+            return None
+        pad = clear[-1] if clear else 0
+        if 0 < pad <= 16:
+            clear = clear[:-pad]
+        self.metrics.observe('sxm_decrypt_cpu_seconds', {}, time.thread_time() - start)
+        self.metrics.inc('sxm_decrypted_bytes_total', {}, len(data))
+        return clear
+
+    def open_segment(self,id,seg,sessionId='',quality=None):
+        # Streaming version of get_segment, returns (content length, chunks).
+        # A cache miss is relayed to the client as it arrives while the
+        # cache fills alongside; others asking for it meanwhile wait for the fill.
+        if self.decrypt:
+            # the cipher works on the whole segment, so decrypted ones are buffered
+            data = self.get_segment(id, seg, sessionId, quality)
+            return (len(data), [data]) if data else None
+        streaminfo = self.get_streaminfo(id, sessionId)
+        if not streaminfo:
+            return None
+        streaminfo = self.rendition(streaminfo, quality)
+        self.poller.touch(id, streaminfo)
+        baseurl = streaminfo["base_url"]
+        HLStag = streaminfo["HLS"]
+        key = (baseurl,HLStag,seg)
+        data, token = self.segment_cache.begin(key)
+        if token is None:
+            return (len(data), [data]) if data else None
+        res = None
+        try:
+            res = self.sopen("{}/{}/{}".format(baseurl,HLStag,seg), stream=True)
+        finally:
+            if res is None:
+                self.segment_cache.finish(key, token, None)
+        if res is None:
+            return None
+        if res.headers.get('Content-Encoding'):
+            # raw bytes wouldn't match what the player expects, buffer this one
+            data = None
+            try:
+                data = res.content
+            finally:
+                self.segment_cache.finish(key, token, data)
+            return (len(data), [data]) if data else None
+        length = res.headers.get('Content-Length')
+        return (int(length) if length else None), SegmentRelay(res, self.segment_cache, key, token)
         
+    def open_stream(self, id, quality=None):
+        # joins (or starts) the shared reader of a channel for /stream, returns the new listener
+        if Cipher is None:
+            self.log("/stream needs the cryptography package to decrypt segments")
+            return None
+        known = self.stream_urls.get(id)
+        if known:
+            # join a running reader without tuning, an Xtra tune would open a whole new session
+            key = (id, self.rendition(known, quality)["HLS"])
+            with self.streams_lock:
+                stream = self.streams.get(key)
+                listener = stream.add() if stream else None
+            if listener is not None:
+                return listener
+        streaminfo = self.get_tuner(id)
+        if not streaminfo:
+            return None
+        streaminfo = self.rendition(streaminfo, quality)
+        key = (id, streaminfo["HLS"])
+        with self.streams_lock:
+            stream = self.streams.get(key)
+            listener = stream.add() if stream else None
+            if listener is None:
+                stream = self.streams[key] = ChannelStream(self, id, quality, streaminfo, self.stream_buffer_segments, self.stream_start_segments, self.setting("stream_stall_timeout", 60))
+                listener = stream.add()
+                threading.Thread(target=stream.run, daemon=True).start()
+        return listener
+
     def getAESkey(self,uuid):
+        # key UUIDs are stable for a long time, every listener shares one fetch
+        return self.key_cache.get_or_fetch(uuid, lambda: self.fetch_aes_key(uuid))
+
+    def fetch_aes_key(self,uuid):
+        key = self.state.get("key", uuid)
+        if key:
+            return key
         data = self.get("playback/key/v1/{}".format(uuid))
         if not data:
             self.log("AES Key fetch error.")
             return False
-        return data["key"]
+        key = base64.b64decode(data["key"])
+        self.state.put("key", uuid, key, self.key_cache.ttl)
+        return key
     
 
+class PooledHTTPServer(HTTPServer):
+    # HTTPServer that hands each connection to a bounded pool of worker threads,
+    # so one slow upstream fetch doesn't stall every other listener
+    request_queue_size = 128 # the default listen backlog of 5 drops bursts of players
+
+    def __init__(self, server_address, RequestHandlerClass, workers=32, bind_and_activate=True):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.detached = set()
+
+    def detach(self, request):
+        # the handler took the connection over (see /stream), don't close it
+        # once the request returns, nor keep a pool worker on it
+        self.detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        super().shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
 def make_sirius_handler(sxm):
     class SiriusHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
+        def route(self):
+            if self.path.startswith('/timeshift/'):
+                return 'timeshift'
+            if self.path.startswith('/record/'):
+                return 'record'
+            if self.path.startswith('/stream/'):
+                return 'stream'
             if self.path.find('.m3u8') > 0:
-                data = sxm.get_playlist()
-                if data:
+                return 'playlist'
+            if self.path.find('.aac') > 0:
+                return 'segment'
+            for route in ('key', 'stats', 'metrics', 'debug', 'epg', 'listen'):
+                if self.path.startswith('/' + route):
+                    return route
+            return 'other'
+
+        def do_GET(self):
+            route = self.route()
+            sxm.metrics.gauge_add('sxm_http_inflight_requests', {'route': route}, 1)
+            try:
+                with sxm.metrics.timer('sxm_http_request_seconds', route=route):
+                    self.handle_GET()
+            finally:
+                sxm.metrics.gauge_add('sxm_http_inflight_requests', {'route': route}, -1)
+
+        def send_body(self, body, content_type, channel=None):
+            # answers If-None-Match with a 304 and gzips for clients that take it
+            if not isinstance(body, EncodedBody):
+                body = EncodedBody(body)
+            if body.etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', body.etag)
+                self.end_headers()
+                return
+            data = body.raw
+            gzipped = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+            if gzipped:
+                data = body.gzipped
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', body.etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.end_headers()
+            if channel:
+                self.served(channel, data)
+            else:
+                self.wfile.write(data)
+
+        def served(self, channel, data):
+            self.wfile.write(data)
+            sxm.metrics.inc('sxm_bytes_served_total', {'channel': channel}, len(data))
+
+        def handle_GET(self):
+            if self.path.startswith('/timeshift/'):
+                # /timeshift/<id>[?quality=] playlist, /timeshift/<id>/<rendition>/<seq>.aac segments
+                path, _, query = self.path.partition("?")
+                dirsplit = path.split("/")
+                if path.endswith('.aac') and len(dirsplit) == 5:
+                    try:
+                        data = sxm.get_timeshift_segment(dirsplit[2], dirsplit[3], int(dirsplit[4][:-4]))
+                    except ValueError:
+                        data = None
+                    if data is None:
+                        self.send_response(404)
+                        self.end_headers()
+                        return
                     self.send_response(200)
-                    self.send_header('Content-Type', 'application/x-mpegURL')
+                    self.send_header('Content-Type', 'audio/x-aac')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.served(dirsplit[2], data)
+                    return
+                id = sxm.resolve_channel(dirsplit[-1])
+                data = sxm.get_timeshift_playlist(id, urllib.parse.parse_qs(query).get("quality", [None])[0])
+                if not data:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_body(data, 'application/x-mpegURL', id)
+            elif self.path.startswith('/record/'):
+                path, _, query = self.path.partition("?")
+                recording = sxm.record(sxm.resolve_channel(path.split('/')[-1]), urllib.parse.parse_qs(query).get("quality", [None])[0])
+                if not recording:
+                    self.send_response(404)
                     self.end_headers()
-                    self.wfile.write(bytes(data, 'utf-8'))
+                    return
+                self.send_body(json.dumps(recording).encode('utf-8'), 'application/json')
+            elif self.path.startswith('/stream/'):
+                # /stream/<id>[?quality=] continuous AAC for players that don't do HLS
+                if not hasattr(self.server, 'detach'):
+                    self.log_message("/stream needs server_mode = threaded")
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                path, _, query = self.path.partition("?")
+                id = sxm.resolve_channel(path.split('/')[-1])
+                listener = sxm.open_stream(id, urllib.parse.parse_qs(query).get("quality", [None])[0])
+                if listener is None:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                channel = sxm.get_channel_info(id)
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/aac')
+                self.send_header('Cache-Control', 'no-cache')
+                if channel:
+                    self.send_header('icy-name', channel.title.encode('latin-1', 'replace').decode('latin-1'))
+                self.end_headers()
+                self.close_connection = True
+                # the stream outlives the request, it gets a thread of its own
+                self.server.detach(self.connection)
+                threading.Thread(target=listener.send, args=(self.connection, sxm.stream_send_timeout), daemon=True).start()
+            elif self.path.find('.m3u8') > 0:
+                query = urllib.parse.parse_qs(self.path.partition('?')[2])
+                data = sxm.get_filtered("m3u", query) if query else sxm.get_playlist()
+                if data:
+                    self.send_body(data, 'application/x-mpegURL')
                     return
                 else:
                     self.send_response(500)
                     self.end_headers()
             elif self.path.find('.aac') > 0:
-                dirsplit = self.path.split("/")
-                id = dirsplit[-2]
-                seg = dirsplit[-1]
-                data = None
-                if self.path.find('?') > 0:
-                    contextId = self.path.split("?")[-1]
-                    data = sxm.get_segment(id,seg,contextId)
+                # /listen/<id>/<rendition>/<seg>.aac?<sessionId>, older players may leave out the rendition
+                path, _, contextId = self.path.partition("?")
+                dirsplit = path.split("/")
+                quality = None
+                if len(dirsplit) > 4 and dirsplit[-4] == 'listen':
+                    quality = dirsplit[-2]
+                    id = dirsplit[-3]
                 else:
-                    data = sxm.get_segment(id,seg)
-                
+                    id = dirsplit[-2]
+                seg = dirsplit[-1]
+                if sxm.stream_segments:
+                    segment = sxm.open_segment(id,seg,contextId,quality)
+                    if not segment:
+                        self.send_response(500)
+                        self.end_headers()
+                        return
+                    length, chunks = segment
+                    try:
+                        # headers inside the try too, a player gone by now must still release the relay
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'audio/x-aac')
+                        if length is not None:
+                            self.send_header('Content-Length', str(length))
+                        self.end_headers()
+                        for chunk in chunks:
+                            self.served(id, chunk)
+                    finally:
+                        if hasattr(chunks, 'close'):
+                            chunks.close()
+                    return
+                data = sxm.get_segment(id,seg,contextId,quality)
                 if data:
                     self.send_response(200)
                     self.send_header('Content-Type', 'audio/x-aac')
+                    self.send_header('Content-Length', str(len(data)))
                     self.end_headers()
-                    self.wfile.write(data)
+                    self.served(id, data)
                 else:
                     self.send_response(500)
                     self.end_headers()
             elif self.path.startswith('/key/'):
                 split = self.path.split("/")
                 uuid = split[-1]
-                key = base64.b64decode(sxm.getAESkey(uuid))
+                key = sxm.getAESkey(uuid)
                 if not key:
                     self.send_response(500)
                     self.end_headers()
@@ -498,12 +2220,49 @@ def make_sirius_handler(sxm):
                     self.send_header('Content-Type', 'text/plain')
                     self.end_headers()
                     self.wfile.write(key)
-            elif self.path.startswith("/listen/"):
-                data = sxm.get_channel(self.path.split('/')[-1])
+            elif self.path == '/stats':
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({"segment_cache": sxm.segment_cache.stats(), "key_cache": sxm.key_cache.stats()}).encode('utf-8'))
+            elif self.path.startswith('/epg.json') or self.path.startswith('/epg.xml'):
+                query = urllib.parse.parse_qs(self.path.partition('?')[2])
+                xmltv = self.path.startswith('/epg.xml')
+                data = sxm.get_filtered("xmltv" if xmltv else "json", query)
+                if not data:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                self.send_body(data, 'application/xml' if xmltv else 'application/json')
+            elif self.path == '/metrics':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.end_headers()
+                self.wfile.write(sxm.metrics.render().encode('utf-8'))
+            elif self.path.startswith('/debug/profile/') and sxm.profiler:
+                # /debug/profile/start begins sampling, /debug/profile/stop returns folded stacks
+                if self.path.endswith('/start'):
+                    data = b'started\n' if sxm.profiler.start() else b'already running\n'
+                else:
+                    data = sxm.profiler.stop().encode('utf-8')
                 self.send_response(200)
-                self.send_header('Content-Type', 'application/x-mpegURL')
+                self.send_header('Content-Type', 'text/plain')
                 self.end_headers()
                 self.wfile.write(data)
+            elif self.path.startswith("/listen/"):
+                path, _, query = self.path.partition("?")
+                id = sxm.resolve_channel(path.split('/')[-1])
+                params = urllib.parse.parse_qs(query)
+                quality = params.get("quality", [None])[0]
+                if quality is None and sxm.master_playlist:
+                    data = sxm.get_master_playlist(id)
+                else:
+                    data = sxm.get_channel(id, quality, params.get("session", [''])[0])
+                if not data:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                self.send_body(data, 'application/x-mpegURL', id)
             else:
                 self.send_response(500)
                 self.end_headers()
@@ -511,6 +2270,51 @@ def make_sirius_handler(sxm):
 
 
 
+def make_server(sxm, address, mode="threaded", workers=32, sock=None):
+    # with `sock` the server accepts on an already bound socket (see run_prefork)
+    handler = make_sirius_handler(sxm)
+    if mode == "single":
+        httpd = HTTPServer(address, handler, bind_and_activate=sock is None)
+    else:
+        httpd = PooledHTTPServer(address, handler, workers, bind_and_activate=sock is None)
+    if sock is not None:
+        httpd.socket = sock
+        httpd.server_address = sock.getsockname()
+        httpd.server_name, httpd.server_port = httpd.server_address[:2]
+    return httpd
+
+def run_prefork(address, processes, start_worker):
+    # Binds the listening socket once, then forks `processes` workers that each
+    # build their own SiriusXM (sharing state through the configured backend)
+    # and accept on that socket; the kernel spreads connections between them.
+    sock = socket.create_server(address, backlog=PooledHTTPServer.request_queue_size)
+    children = []
+    for i in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                start_worker(sock)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sock.close()
+
 if __name__ == '__main__':
     config.read('config.ini')
     email = config.get("account","email")
@@ -518,11 +2322,23 @@ if __name__ == '__main__':
 
     ip = config.get("settings","ip")
     port = int(config.get("settings","port"))
+    mode = config.get("settings","server_mode",fallback="threaded")
+    workers = config.getint("settings","workers",fallback=32)
+    processes = config.getint("settings","processes",fallback=1)
     print("Starting server at {}:{}".format(ip, port))
-    sxm = SiriusXM(email, password)
-    httpd = HTTPServer((ip, port), make_sirius_handler(sxm))
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    httpd.server_close()
+    if processes > 1:
+        if config.get("settings","state_backend",fallback="none") != "sqlite":
+            print("processes > 1 needs shared state, using state_backend = sqlite")
+            config.set("settings","state_backend","sqlite")
+        def start_worker(sock):
+            sxm = SiriusXM(email, password, config["settings"])
+            make_server(sxm, (ip, port), mode, workers, sock).serve_forever()
+        run_prefork((ip, port), processes, start_worker)
+    else:
+        sxm = SiriusXM(email, password, config["settings"])
+        httpd = make_server(sxm, (ip, port), mode, workers)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        httpd.server_close()
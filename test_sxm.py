@@ -0,0 +1,494 @@
+import gzip
+import http.client
+import io
+import threading
+import time
+import unittest
+
+import sxm
+from sxm import LRUCache, SiriusXM, TunerStore, EncodedBody, Metrics, make_sirius_handler, Channel, ChannelCatalog, parse_media_segments, strip_id3, SegmentRelay, AuthManager, NullState, accepts_gzip
+
+# Run with: python -m unittest test_sxm
+
+class LRUCacheTest(unittest.TestCase):
+    def test_byte_budget_evicts_oldest(self):
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.put("a", b"12345")
+        cache.put("b", b"12345")
+        cache.get("a")
+        cache.put("c", b"12345")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"12345")
+        self.assertLessEqual(cache.stats()["bytes"], 10)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return b"data"
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get_or_fetch("k", fetch)))
+        first.start()
+        started.wait(5)
+        waiters = [threading.Thread(target=lambda: results.append(cache.get_or_fetch("k", fetch))) for _ in range(5)]
+        for t in waiters:
+            t.start()
+        release.set()
+        for t in [first] + waiters:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b"data"] * 6)
+
+    def test_waiters_released_when_fetch_fails(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        def failing():
+            started.set()
+            release.wait(5)
+            raise IOError("upstream went away")
+        errors = []
+        def first():
+            try:
+                cache.get_or_fetch("k", failing)
+            except IOError as e:
+                errors.append(e)
+        t = threading.Thread(target=first)
+        t.start()
+        started.wait(5)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(cache.get_or_fetch("k", lambda: b"unused")))
+        waiter.start()
+        release.set()
+        t.join(5)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(results, [None])
+        # nothing is left in flight, the next caller fetches again
+        self.assertEqual(cache.inflight, {})
+        self.assertEqual(cache.get_or_fetch("k", lambda: b"fresh"), b"fresh")
+
+def channel_item(number):
+    # one channel as the browse api lists it
+    return {
+        "entity": {
+            "id": "id{}".format(number),
+            "texts": {"title": {"default": "Channel {}".format(number)}, "description": {"default": ""}},
+            "images": {"tile": {"aspect_1x1": {"preferred": {"url": "logo{}".format(number), "width": 300, "height": 300}}}}
+        },
+        "decorations": {"channelNumber": str(number), "genre": "Rock" if number % 2 else "Jazz"},
+        "actions": {"play": [{"entity": {"type": "channel-linear" if number < 100 else "channel-xtra"}}]}
+    }
+
+def offline_sxm(**attrs):
+    # a SiriusXM without its background threads, callers stub the upstream calls
+    sxm_ = SiriusXM.__new__(SiriusXM)
+    sxm_.settings = None
+    sxm_.log = lambda x: None
+    sxm_.__dict__.update(attrs)
+    return sxm_
+
+class ChannelPagesTest(unittest.TestCase):
+    def browse(self, total, failing=()):
+        def post(method, postdata, **kwargs):
+            if "/containers/" not in method:
+                return {"page": {"containers": [{"sets": [{"items": [channel_item(n) for n in range(min(total, 50))], "pagination": {"offset": {"size": total}}}]}]}}
+            offset = postdata["sets"]["5mqCLZ21qAwnufKT8puUiM"]["pagination"]["offset"]["setItemsOffset"]
+            if offset in failing:
+                return None
+            return {"container": {"sets": [{"items": [channel_item(n) for n in range(offset, min(total, offset + 50))]}]}}
+        return offline_sxm(post=post)
+
+    def test_every_page_is_fetched(self):
+        self.assertEqual(len(self.browse(180).fetch_channels()), 180)
+
+    def test_a_failed_page_rejects_the_list(self):
+        self.assertIsNone(self.browse(180, failing=(100,)).fetch_channels())
+
+class TunerStoreTest(unittest.TestCase):
+    def test_expired_entries_are_swept(self):
+        store = TunerStore(ttl=0.05, max_entries=10)
+        store.put("a", 1)
+        store.put("b", 2, ttl=60)
+        time.sleep(0.1)
+        self.assertEqual(store.cleanup(), 1)
+        self.assertEqual(len(store), 1)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("b"), 2)
+
+    def test_cap_evicts_least_recently_used(self):
+        store = TunerStore(ttl=60, max_entries=3)
+        for key in "abc":
+            store.put(key, key)
+        store.get("a")
+        store.put("d", "d")
+        self.assertEqual(len(store), 3)
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("a"), "a")
+
+    def test_stale_heap_items_are_compacted(self):
+        store = TunerStore(ttl=60, max_entries=2)
+        for i in range(500):
+            store.put(i % 5, i)
+        store.cleanup()
+        self.assertLessEqual(len(store.heap), 2 * len(store) + 64)
+        self.assertEqual(len(store), 2)
+
+    def test_expiring_only_lists_used_entries(self):
+        store = TunerStore(ttl=5, max_entries=10)
+        store.put("used", 1)
+        store.put("idle", 2)
+        time.sleep(0.01)
+        store.get("used")
+        self.assertEqual(store.expiring(10), ["used"])
+
+def streaminfo(sessionId=None):
+    variants = {}
+    for name, bandwidth in (("256k", 281600), ("32k", 35200), ("64k", 70400)):
+        variants[name] = {
+            "quality": "{0}/x_{0}.m3u8".format(name),
+            "HLS": name,
+            "inf": '#EXT-X-STREAM-INF:BANDWIDTH={},CODECS="mp4a.40.2"'.format(bandwidth),
+            "bandwidth": bandwidth
+        }
+    return {"base_url": "https://cdn/x/chid", "sessionId": sessionId, "variants": variants}
+
+class MasterPlaylistTest(unittest.TestCase):
+    def test_renditions_in_bandwidth_order(self):
+        sxm_ = offline_sxm(get_tuner=lambda id: streaminfo())
+        lines = sxm_.get_master_playlist("id1").decode().splitlines()
+        self.assertEqual(lines[0], "#EXTM3U")
+        self.assertEqual(lines[2::2], ["id1?quality=32k", "id1?quality=64k", "id1?quality=256k"])
+        self.assertTrue(lines[1].startswith("#EXT-X-STREAM-INF:BANDWIDTH=35200"))
+
+    def test_xtra_session_carried_to_every_rendition(self):
+        sxm_ = offline_sxm(get_tuner=lambda id: streaminfo("123"))
+        urls = sxm_.get_master_playlist("id1").decode().splitlines()[2::2]
+        self.assertTrue(all(url.endswith("&session=123") for url in urls))
+
+    def test_rendition_fallback(self):
+        sxm_ = offline_sxm(default_quality="64k")
+        self.assertEqual(sxm_.rendition(streaminfo(), "32k")["HLS"], "32k")
+        # unknown qualities get the configured default
+        self.assertEqual(sxm_.rendition(streaminfo(), "96k")["HLS"], "64k")
+        # and a default the channel doesn't carry gets the highest bandwidth
+        sxm_.default_quality = "128k"
+        self.assertEqual(sxm_.rendition(streaminfo(), "96k")["HLS"], "256k")
+        self.assertEqual(sxm_.rendition(streaminfo())["quality"], "256k/x_256k.m3u8")
+
+def call_send_body(body, **headers):
+    # runs the handler's send_body without a socket, returns (status, headers, payload)
+    handler_class = make_sirius_handler(offline_sxm(metrics=Metrics()))
+    handler = handler_class.__new__(handler_class)
+    handler.request_version = handler.protocol_version = "HTTP/1.1"
+    handler.requestline = "GET /listen/id1 HTTP/1.1"
+    handler.command = "GET"
+    handler.client_address = ("127.0.0.1", 0)
+    handler.log_message = lambda *args: None
+    handler.headers = http.client.parse_headers(io.BytesIO("".join("{}: {}\r\n".format(k.replace("_", "-"), v) for k, v in headers.items()).encode() + b"\r\n"))
+    handler.wfile = io.BytesIO()
+    handler.send_body(body, "application/x-mpegURL")
+    head, _, payload = handler.wfile.getvalue().partition(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    return int(lines[0].split()[1]), http.client.parse_headers(io.BytesIO("\r\n".join(lines[1:]).encode() + b"\r\n\r\n")), payload
+
+class SendBodyTest(unittest.TestCase):
+    BODY = b"#EXTM3U\n" * 200
+
+    def test_plain(self):
+        status, headers, payload = call_send_body(self.BODY)
+        self.assertEqual(status, 200)
+        self.assertEqual(payload, self.BODY)
+        self.assertIsNone(headers["Content-Encoding"])
+        self.assertEqual(headers["ETag"], EncodedBody(self.BODY).etag)
+
+    def test_gzip(self):
+        status, headers, payload = call_send_body(self.BODY, Accept_Encoding="gzip, deflate")
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(int(headers["Content-Length"]), len(payload))
+        self.assertEqual(gzip.decompress(payload), self.BODY)
+
+    def test_matching_etag_gets_304(self):
+        etag = EncodedBody(self.BODY).etag
+        status, headers, payload = call_send_body(self.BODY, If_None_Match='"other", ' + etag)
+        self.assertEqual(status, 304)
+        self.assertEqual(payload, b"")
+        status, _, _ = call_send_body(self.BODY, If_None_Match='"other"')
+        self.assertEqual(status, 200)
+
+def catalog():
+    # 1..9 are linear, 100..104 Xtra; odd numbers are Rock, even ones Jazz
+    return ChannelCatalog([Channel("id{}".format(n), "Channel {}".format(n), "", "Rock" if n % 2 else "Jazz", str(n), "channel-linear" if n < 100 else "channel-xtra", "") for n in list(range(1, 10)) + list(range(100, 105))])
+
+class SelectTest(unittest.TestCase):
+    def numbers(self, channels):
+        return [int(channel.channel_id) for channel in channels]
+
+    def test_no_filter_is_the_whole_catalog(self):
+        self.assertEqual(len(catalog().select()), 14)
+
+    def test_filters_combine(self):
+        channels = catalog()
+        self.assertEqual(self.numbers(channels.select(genres=["rock"], types=["linear"])), [1, 3, 5, 7, 9])
+        self.assertEqual(self.numbers(channels.select(ranges=[(3, 5), (100, 101)])), [3, 4, 5, 100, 101])
+        self.assertEqual(self.numbers(channels.select(genres=["Jazz"], ranges=[(1, 200)], types=["xtra"])), [100, 102, 104])
+        self.assertEqual(self.numbers(channels.select(ids=["id104", "id2", "missing"])), [2, 104])
+        self.assertEqual(channels.select(genres=["Pop"]), [])
+
+    def test_filtered_playlist(self):
+        sxm_ = offline_sxm(channels=catalog())
+        body = sxm_.get_filtered("m3u", {"genre": ["Jazz"], "channels": ["1-5,bad"]})
+        self.assertEqual([line for line in body.raw.decode().splitlines() if line.startswith("/listen/")], ["/listen/id2", "/listen/id4"])
+        self.assertIs(sxm_.get_filtered("m3u", {"genre": ["Jazz"], "channels": ["1-5,bad"]}), body)
+
+PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:10
+#EXT-X-MEDIA-SEQUENCE:41
+#EXT-X-KEY:METHOD=AES-128,URI="https://api/playback/key/v1/abc"
+#EXTINF:9.5,
+a_41.aac
+#EXTINF:10,
+a_42.aac
+#EXT-X-KEY:METHOD=AES-128,URI="https://api/playback/key/v1/def",IV=0x0000000000000000000000000000000f
+#EXTINF:10,
+a_43.aac
+"""
+
+class ParseTest(unittest.TestCase):
+    def test_media_segments(self):
+        targetduration, segments = parse_media_segments(PLAYLIST)
+        self.assertEqual(targetduration, 10)
+        self.assertEqual([s["name"] for s in segments], ["a_41.aac", "a_42.aac", "a_43.aac"])
+        self.assertEqual([s["sequence"] for s in segments], [41, 42, 43])
+        self.assertEqual(segments[0]["duration"], 9.5)
+        self.assertIn("/abc", segments[1]["key"])
+        self.assertIn("IV=0x", segments[2]["key"])
+
+@unittest.skipIf(sxm.Cipher is None, "needs the cryptography package")
+class DecryptTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from fakexm import start_fake
+        from benchmark import settings_for
+        cls.fake, cls.server = start_fake(channels=10, segment_seconds=2)
+        cls.sxm = sxm.SiriusXM("user", "pass", settings_for(cls.fake))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def test_round_trip_with_iv_from_sequence(self):
+        _, entries = parse_media_segments(self.fake.media_playlist("ch1", "64k"))
+        for entry in entries[-2:]:
+            encrypted = self.fake.segment(entry["name"])
+            self.assertNotEqual(encrypted, self.fake.payloads["64k"])
+            self.assertEqual(self.sxm.decrypt_segment(encrypted, entry), self.fake.payloads["64k"])
+
+    def test_round_trip_with_explicit_iv(self):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        iv = bytes(range(16, 32))
+        data = b"clear aac" * 10
+        pad = 16 - len(data) % 16
+        encryptor = Cipher(algorithms.AES(self.fake.key), modes.CBC(iv)).encryptor()
+        encrypted = encryptor.update(data + bytes([pad]) * pad) + encryptor.finalize()
+        entry = {"name": "x.aac", "sequence": 7, "key": '#EXT-X-KEY:METHOD=AES-128,URI="{}/api/playback/key/v1/{}",IV=0x{}'.format(self.fake.base, self.fake.key_id, iv.hex())}
+        self.assertEqual(self.sxm.decrypt_segment(encrypted, entry), data)
+
+    def test_unencrypted_segments_pass_through(self):
+        entry = {"name": "x.aac", "sequence": 1, "key": "#EXT-X-KEY:METHOD=NONE"}
+        self.assertEqual(self.sxm.decrypt_segment(b"plain", entry), b"plain")
+
+class StripID3Test(unittest.TestCase):
+    def test_strip_id3(self):
+        tag = b"ID3\x04\x00\x00\x00\x00\x00\x05" + b"\x00" * 5
+        with_footer = b"ID3\x04\x00\x10\x00\x00\x00\x02xx" + b"3DI" + b"\x00" * 7
+        self.assertEqual(bytes(strip_id3(tag + b"\xff\xf1audio")), b"\xff\xf1audio")
+        self.assertEqual(bytes(strip_id3(tag + with_footer + b"\xff\xf1")), b"\xff\xf1")
+        self.assertEqual(bytes(strip_id3(b"\xff\xf1audio")), b"\xff\xf1audio")
+
+class BrokenRaw(io.BytesIO):
+    # a body the upstream breaks off once the bytes it holds are read
+    def readinto(self, buf):
+        n = super().readinto(buf)
+        if not n:
+            raise IOError("IncompleteRead")
+        return n
+
+class FakeResponse:
+    def __init__(self, body, length=None, raw=io.BytesIO):
+        self.raw = raw(body)
+        self.headers = {"Content-Length": str(length)} if length else {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class SegmentRelayTest(unittest.TestCase):
+    def test_relay_fills_the_cache(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        _, token = cache.begin("seg")
+        relay = SegmentRelay(FakeResponse(b"x" * 100, length=100), cache, "seg", token, chunk_size=32)
+        self.assertEqual(b"".join(bytes(chunk) for chunk in relay), b"x" * 100)
+        self.assertEqual(cache.get("seg"), b"x" * 100)
+
+    def test_closing_an_unstarted_relay_releases_the_fill(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        _, token = cache.begin("seg")
+        res = FakeResponse(b"abc")
+        relay = SegmentRelay(res, cache, "seg", token)
+        relay.close()
+        self.assertTrue(res.closed)
+        self.assertEqual(cache.inflight, {})
+        self.assertEqual(cache.begin("seg"), (b"abc", None))
+
+    def test_broken_off_body_is_not_cached(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        _, token = cache.begin("seg")
+        relay = SegmentRelay(FakeResponse(b"x" * 70, length=200, raw=BrokenRaw), cache, "seg", token, chunk_size=32)
+        with self.assertRaises(IOError):
+            for chunk in relay:
+                pass
+        # the handler closes the relay on its way out
+        relay.close()
+        self.assertEqual(cache.inflight, {})
+        self.assertIsNone(cache.get("seg"))
+
+    def test_short_body_is_not_cached(self):
+        cache = LRUCache(max_bytes=1000, ttl=60)
+        _, token = cache.begin("seg")
+        relay = SegmentRelay(FakeResponse(b"x" * 70, length=200), cache, "seg", token, chunk_size=32)
+        self.assertEqual(len(b"".join(bytes(chunk) for chunk in relay)), 70)
+        self.assertIsNone(cache.get("seg"))
+        _, token = cache.begin("seg")
+        relay = SegmentRelay(FakeResponse(b"x" * 70, length=200), cache, "seg", token)
+        relay.close()
+        self.assertIsNone(cache.get("seg"))
+        self.assertEqual(cache.inflight, {})
+
+    def test_waiting_on_an_abandoned_fill_is_bounded(self):
+        cache = LRUCache(max_bytes=1000, ttl=60, wait_timeout=0.1)
+        value, token = cache.begin("k")
+        self.assertIsNotNone(token)
+        start = time.time()
+        self.assertEqual(cache.begin("k"), (None, None))
+        self.assertLess(time.time() - start, 2)
+
+class MetricsTest(unittest.TestCase):
+    def test_metric_families_are_contiguous(self):
+        metrics = Metrics()
+        metrics.collectors.append(lambda: [
+            ("a_total", "counter", {"cache": "segment"}, 1),
+            ("b_bytes", "gauge", {"cache": "segment"}, 2),
+            ("a_total", "counter", {"cache": "key"}, 3),
+            ("b_bytes", "gauge", {"cache": "key"}, 4)
+        ])
+        names = [line.split("{")[0] for line in metrics.render().splitlines() if not line.startswith("#")]
+        self.assertEqual(names, ["a_total", "a_total", "b_bytes", "b_bytes"])
+
+class FakeSession:
+    def __init__(self):
+        self.headers = {}
+        self.cookies = {}
+
+class LoginStub:
+    # the parts of SiriusXM the AuthManager uses, with a slow login that works or not
+    def __init__(self, works):
+        self.works = works
+        self.logins = 0
+        self.session = FakeSession()
+        self.metrics = Metrics()
+        self.state = NullState()
+        self.log = lambda x: None
+
+    def is_session_authenticated(self):
+        return "Authorization" in self.session.headers
+
+    def new_session(self):
+        return FakeSession()
+
+    def login(self, session):
+        self.logins += 1
+        time.sleep(0.2)
+        return self.works
+
+    def authenticate(self, session):
+        session.headers["Authorization"] = "Bearer token{}".format(self.logins)
+        return True
+
+class AuthManagerTest(unittest.TestCase):
+    def storm(self, auth, callers=20):
+        generation = auth.generation
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(auth.refresh(generation))) for _ in range(callers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_concurrent_callers_share_one_login(self):
+        stub = LoginStub(works=True)
+        auth = AuthManager(stub, 3600, 300, 5, 300)
+        self.assertEqual(self.storm(auth), [True] * 20)
+        self.assertEqual(stub.logins, 1)
+        self.assertEqual(stub.session.headers["Authorization"], "Bearer token1")
+
+    def test_concurrent_callers_share_one_failed_login(self):
+        stub = LoginStub(works=False)
+        auth = AuthManager(stub, 3600, 300, 0.3, 300)
+        self.assertEqual(self.storm(auth), [False] * 20)
+        self.assertEqual(stub.logins, 1)
+        # backing off, no new attempt yet
+        self.assertFalse(auth.refresh(auth.generation))
+        self.assertEqual(stub.logins, 1)
+        time.sleep(0.4)
+        stub.works = True
+        self.assertTrue(auth.refresh(auth.generation))
+        self.assertEqual(stub.logins, 2)
+        self.assertEqual(auth.retry_at, 0)
+
+    def test_backoff_grows_to_its_cap(self):
+        stub = LoginStub(works=False)
+        auth = AuthManager(stub, 3600, 300, 1, 3)
+        delays = []
+        for _ in range(4):
+            auth.retry_at = 0
+            auth.refresh(auth.generation)
+            delays.append(round(auth.retry_at - time.time()))
+        self.assertEqual(delays, [1, 2, 3, 3])
+
+class SegmentChannelTest(unittest.TestCase):
+    def test_unknown_id_with_a_valid_session_is_rejected(self):
+        sessions = TunerStore(ttl=60, max_entries=10)
+        sessions.put("123", streaminfo("123"))
+        sxm_ = offline_sxm(channels=catalog(), xtra_streams=sessions)
+        self.assertEqual(sxm_.get_streaminfo("id100", "123")["sessionId"], "123")
+        self.assertIsNone(sxm_.get_streaminfo("made-up", "123"))
+
+class AcceptEncodingTest(unittest.TestCase):
+    def test_q_values(self):
+        self.assertTrue(accepts_gzip("gzip"))
+        self.assertTrue(accepts_gzip("deflate, GZIP;q=0.5"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip(""))
+        self.assertFalse(accepts_gzip("gzip;q=0"))
+        self.assertFalse(accepts_gzip("gzip; q=0.0, *"))
+        self.assertFalse(accepts_gzip("*;q=0"))
+        self.assertFalse(accepts_gzip("x-gzip, deflate"))
+        self.assertFalse(accepts_gzip("identity"))
+
+    def test_refused_gzip_is_sent_plain(self):
+        body = b"#EXTM3U\n" * 200
+        _, headers, payload = call_send_body(body, Accept_Encoding="gzip;q=0, identity")
+        self.assertIsNone(headers["Content-Encoding"])
+        self.assertEqual(payload, body)
+
+if __name__ == '__main__':
+    unittest.main()